@@ -0,0 +1,372 @@
+# =============================== #
+# @File    : C200_benchmark.py
+# 使用 Fashion-MNIST 网络各层的尺寸 (以及 4x / 16x 放大的尺寸), 对 C200_utils / C200_module 中的计算核测速,
+# 统计峰值内存 (tracemalloc), 并逐位检查快速实现与参考实现的结果是否一致
+# 运行: python C200_benchmark.py [--scales 1 4 16] [--repeat 5] [--kernels im2col ...] [--json results.json]
+# =============================== #
+import sys
+import json
+import time
+import argparse
+import platform
+import datetime
+import tracemalloc
+import numpy as np
+from C200_module import *
+
+# ========================================= #
+# Fashion-MNIST 网络各层参数
+# ========================================= #
+# conv 层: input_shape = [C, H, W], weight 为复制后的 [rows * repeat[0], cols * repeat[1]]
+# fc 层: input_shape = [rows]
+LAYER_SHAPES = {
+    'conv1': dict(input_shape = [1, 28, 28], kernel_size = 3, stride = 1, padding = 1,
+                  out_channels = 8, repeat = [64, 4]),
+    'conv2': dict(input_shape = [8, 14, 14], kernel_size = 3, stride = 2, padding = 0,
+                  out_channels = 16, repeat = [8, 2]),
+    'fc1': dict(input_shape = [144], out_channels = 48, repeat = [4, 1]),
+    'fc2': dict(input_shape = [48], out_channels = 10, repeat = [10, 1]),
+}
+
+SCALES = [1, 4, 16]
+BATCH_SIZE = 8
+
+input_half_level = 15
+weight_half_level = 7
+
+
+# 放大 scale 倍的层参数: conv 层的 H, W 各放大 sqrt(scale) 倍, fc 层的输入长度放大 scale 倍
+def scaled_layer(layer, scale = 1):
+    shape = dict(LAYER_SHAPES[layer])
+    if 'kernel_size' in shape:
+        c, h, w = shape['input_shape']
+        k = int(round(np.sqrt(scale)))
+        shape['input_shape'] = [c, h * k, w * k]
+    else:
+        shape['input_shape'] = [shape['input_shape'][0] * scale]
+    return shape
+
+
+# 生成一层的随机量化输入与权重
+def make_layer_data(layer, rng, scale = 1):
+    shape = scaled_layer(layer, scale)
+    feature_map = rng.integers(-input_half_level, input_half_level + 1, size = shape['input_shape'])
+    if 'kernel_size' in shape:
+        array_input = feature_map_to_input(feature_map, kernel_size = shape['kernel_size'],
+                                           stride = shape['stride'], padding = shape['padding'],
+                                           repeat = shape['repeat'])
+    else:
+        array_input = np.tile(feature_map.reshape(-1, 1), [shape['repeat'][0], 1])
+    rows = array_input.shape[0]
+    cols = shape['out_channels'] * shape['repeat'][1]
+    weight = rng.integers(-weight_half_level, weight_half_level + 1, size = [rows, cols])
+    return array_input, weight
+
+
+def time_it(func, repeat = 5):
+    best = float('inf')
+    for _ in range(repeat):
+        t = time.perf_counter()
+        func()
+        best = min(best, time.perf_counter() - t)
+    return best
+
+
+# 单独运行一次, 返回 tracemalloc 统计的峰值内存 (字节)
+def peak_memory(func):
+    tracemalloc.start()
+    try:
+        func()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return peak
+
+
+def same(a, b):
+    if isinstance(a, tuple):
+        return all(same(x, y) for x, y in zip(a, b))
+    a = np.asarray(a)
+    b = np.asarray(b)
+    return a.shape == b.shape and bool((a == b).all())
+
+
+# 测量一组实现: funcs 为 {名称: 函数}, 第一个为参考实现, 其余实现的结果必须与之逐位一致
+def measure(case, funcs, repeat = 5, ref_repeat = 1):
+    results = dict(case)
+    outputs = {}
+    for i, (name, func) in enumerate(funcs.items()):
+        outputs[name] = func()
+        results[name] = dict(time = time_it(func, ref_repeat if i == 0 else repeat),
+                             peak_memory = peak_memory(func))
+    names = list(funcs)
+    results['exact'] = {name: same(outputs[names[0]], outputs[name]) for name in names[1:]}
+    results['speedup'] = {name: results[names[0]]['time'] / max(results[name]['time'], 1e-12)
+                          for name in names[1:]}
+    return results
+
+
+# ========================================= #
+# 各计算核
+# ========================================= #
+# 把 lazy = True 返回的 [repeat[0], rows, cal_times] 复制视图展开成二维输入
+def materialize(lazy_input):
+    return lazy_input.reshape(-1, lazy_input.shape[-1])
+
+
+# im2col: 逐窗口实现 vs sliding_window_view (复制后 / 复制视图)
+def bench_im2col(scale, rng, repeat):
+    results = {}
+    for layer in LAYER_SHAPES:
+        shape = scaled_layer(layer, scale)
+        if 'kernel_size' not in shape:
+            continue
+        feature_map = rng.integers(-input_half_level, input_half_level + 1, size = shape['input_shape'])
+        args = (feature_map, shape['kernel_size'], shape['stride'], shape['padding'], shape['repeat'])
+        results[layer] = measure(dict(input_shape = shape['input_shape']), {
+            'loop': lambda: feature_map_to_input_loop(*args),
+            'fast': lambda: feature_map_to_input(*args),
+            'lazy': lambda: materialize(feature_map_to_input(*args, lazy = True)),
+        }, repeat)
+    return results
+
+
+# bitwise 展开: 逐脉冲实现 vs 闭式展开
+def bench_bitwise_expansion(scale, rng, repeat):
+    results = {}
+    for layer in LAYER_SHAPES:
+        array_input, _ = make_layer_data(layer, rng, scale)
+        results[layer] = measure(dict(input_shape = list(array_input.shape)), {
+            'loop': lambda: input_bitwise_expansion_loop(array_input),
+            'fast': lambda: input_bitwise_expansion_fast(array_input),
+        }, repeat)
+    return results
+
+
+# sdk_cal_sim: 逐列实现 vs gemm 引擎
+def bench_sdk_cal_sim(scale, rng, repeat):
+    results = {}
+    for layer in LAYER_SHAPES:
+        array_input, weight = make_layer_data(layer, rng, scale)
+        input_expanded, _ = input_bitwise_expansion_fast(array_input)
+        results[layer] = measure(dict(expanded_shape = list(input_expanded.shape)), {
+            'loop': lambda: sdk_cal_sim_loop(input_expanded, weight),
+            'gemm': lambda: sdk_cal_sim(input_expanded, weight),
+            'gemm_int16': lambda: sdk_cal_sim(input_expanded, weight, acc_dtype = np.int16),
+        }, repeat)
+    return results
+
+
+# 参考实现组合出的 mvm_bitwise_concat_push_fast
+def mvm_bitwise_concat_push_loop(input, weight, repeat = None):
+    input_expanded, bitlen_map = input_bitwise_expansion_loop(input)
+    output = np.zeros([input.shape[1], weight.shape[1]])
+    if len(bitlen_map) > 0:
+        bitwise_segment_sum_loop(sdk_cal_sim_loop(input_expanded, weight), bitlen_map, out = output)
+    if repeat:
+        return repeat_avg(output, repeat)
+    return output
+
+
+# CPU 仿真乘加: 参考实现组合 vs 快速展开 / 复制视图 / ideal 矩阵乘
+def bench_mvm(scale, rng, repeat):
+    results = {}
+    for layer in LAYER_SHAPES:
+        shape = scaled_layer(layer, scale)
+        array_input, weight = make_layer_data(layer, rng, scale)
+        rep = shape['repeat']
+        lazy_input = np.broadcast_to(array_input[:array_input.shape[0] // rep[0]],
+                                     (rep[0], array_input.shape[0] // rep[0], array_input.shape[1]))
+        results[layer] = measure(dict(input_shape = list(array_input.shape)), {
+            'loop': lambda: mvm_bitwise_concat_push_loop(array_input, weight, rep),
+            'fast': lambda: mvm_bitwise_concat_push_fast(array_input, weight, rep),
+            'lazy': lambda: mvm_bitwise_concat_push_fast(lazy_input, weight, rep),
+            'ideal': lambda: mvm_bitwise_concat_push_fast(array_input, weight, rep, ideal = True),
+        }, repeat)
+    return results
+
+
+# weight_avg: 逐块实现 vs reshape 求和
+def bench_weight_avg(scale, rng, repeat):
+    results = {}
+    for layer in LAYER_SHAPES:
+        shape = scaled_layer(layer, scale)
+        _, weight = make_layer_data(layer, rng, scale)
+        weight = weight + 8
+        results[layer] = measure(dict(weight_shape = list(weight.shape)), {
+            'loop': lambda: weight_avg_loop(weight, shape['repeat']),
+            'fast': lambda: weight_avg(weight, shape['repeat']),
+        }, repeat)
+    return results
+
+
+# 量化: 逐张调用 data_quantization_sym vs 整个 batch 的 data_quantization_sym_batch
+def bench_quantization(scale, rng, repeat):
+    results = {}
+    for layer in LAYER_SHAPES:
+        shape = scaled_layer(layer, scale)
+        data = rng.normal(size = [BATCH_SIZE] + shape['input_shape'])
+        results[layer] = measure(dict(batch_shape = list(data.shape)), {
+            'loop': lambda: np.stack([data_quantization_sym(d, half_level = input_half_level, isint = 1)[0]
+                                      for d in data]),
+            'batch': lambda: data_quantization_sym_batch(data, half_level = input_half_level, isint = 1)[0],
+        }, repeat)
+    return results
+
+
+# 原始的单张 [C, H, W] 池化实现, 作为参考
+def pooling_ref(feature_map, kernel_size):
+    channels = feature_map.shape[0]
+    pooled_rows = int(feature_map.shape[1] / kernel_size)
+    pooled_cols = int(feature_map.shape[2] / kernel_size)
+    output = feature_map.reshape(channels, pooled_rows, kernel_size, pooled_cols, kernel_size)
+    return output.max(axis = (2, 4))
+
+
+# 池化: 逐张参考实现 vs batch 池化
+def bench_pooling(scale, rng, repeat):
+    results = {}
+    for layer in LAYER_SHAPES:
+        shape = scaled_layer(layer, scale)
+        if 'kernel_size' not in shape:
+            continue
+        _, h, w = shape['input_shape']
+        out_h = (h + 2 * shape['padding'] - shape['kernel_size']) // shape['stride'] + 1
+        out_w = (w + 2 * shape['padding'] - shape['kernel_size']) // shape['stride'] + 1
+        data = rng.integers(0, input_half_level + 1, size = [BATCH_SIZE, shape['out_channels'],
+                                                             out_h // 2 * 2, out_w // 2 * 2])
+        results[layer] = measure(dict(batch_shape = list(data.shape)), {
+            'loop': lambda: np.stack([pooling_ref(d, 2) for d in data]),
+            'batch': lambda: pooling(data, 2),
+        }, repeat)
+    return results
+
+
+# 乘加之后的处理: relu + 量化 + 重排 + 池化 分步计算 vs post_mvm_fused (先量化 / 先池化)
+def bench_post_mvm(scale, rng, repeat):
+    results = {}
+    for layer in LAYER_SHAPES:
+        shape = scaled_layer(layer, scale)
+        if 'kernel_size' not in shape:
+            continue
+        _, h, w = shape['input_shape']
+        out_h = (h + 2 * shape['padding'] - shape['kernel_size']) // shape['stride'] + 1
+        out_w = (w + 2 * shape['padding'] - shape['kernel_size']) // shape['stride'] + 1
+        out_h, out_w = out_h // 2 * 2, out_w // 2 * 2
+        data = rng.normal(size = [BATCH_SIZE, out_h * out_w, shape['out_channels']]) * 100
+
+        def unfused(output):
+            output = output.copy()
+            output[output < 0] = 0
+            output, _ = data_quantization_sym(output, half_level = input_half_level, isint = 1)
+            return pooling_ref(output_to_feature_map(output, out_h, out_w), 2)
+
+        results[layer] = measure(dict(batch_shape = list(data.shape)), {
+            'unfused': lambda: np.stack([unfused(d) for d in data]),
+            'fused': lambda: post_mvm_fused(data, out_h, out_w, input_half_level, pool = 2, pool_first = False),
+            'pool_first': lambda: post_mvm_fused(data, out_h, out_w, input_half_level, pool = 2),
+        }, repeat)
+    return results
+
+
+# 逐输出位置的通用池化参考实现 (与 PyTorch max_pool2d / avg_pool2d 的定义相同)
+def pooling2d_ref(feature_map, kernel_size, stride, padding, mode = 'max', ceil_mode = False):
+    rows, cols = feature_map.shape[-2:]
+    out_rows = pooling_output_size(rows, kernel_size, stride, padding, ceil_mode)
+    out_cols = pooling_output_size(cols, kernel_size, stride, padding, ceil_mode)
+    output = np.zeros(feature_map.shape[:-2] + (out_rows, out_cols))
+    for i in range(out_rows):
+        for j in range(out_cols):
+            r0, c0 = i * stride - padding, j * stride - padding
+            r1, c1 = min(r0 + kernel_size, rows + padding), min(c0 + kernel_size, cols + padding)
+            window = feature_map[..., max(r0, 0):min(r1, rows), max(c0, 0):min(c1, cols)]
+            if mode == 'max':
+                output[..., i, j] = window.max(axis = (-2, -1))
+            else:
+                output[..., i, j] = window.sum(axis = (-2, -1)) / ((r1 - r0) * (c1 - c0))
+    return output
+
+
+# 重叠 / padding / ceil_mode 池化: 逐位置参考实现 vs pooling2d, 整数输入使平均池化的结果也逐位一致
+def bench_pooling2d(scale, rng, repeat):
+    results = {}
+    for layer in LAYER_SHAPES:
+        shape = scaled_layer(layer, scale)
+        if 'kernel_size' not in shape:
+            continue
+        _, h, w = shape['input_shape']
+        data = rng.integers(0, input_half_level + 1, size = [BATCH_SIZE, shape['out_channels'], h, w])
+        for mode in ('max', 'avg'):
+            results[f'{layer}_{mode}'] = measure(dict(batch_shape = list(data.shape), kernel_size = 3, stride = 2,
+                                                      padding = 1, ceil_mode = True), {
+                'loop': lambda: pooling2d_ref(data, 3, 2, 1, mode, ceil_mode = True),
+                'fast': lambda: pooling2d(data, 3, 2, 1, mode, ceil_mode = True),
+            }, repeat)
+    return results
+
+
+KERNELS = {
+    'im2col': bench_im2col,
+    'bitwise_expansion': bench_bitwise_expansion,
+    'sdk_cal_sim': bench_sdk_cal_sim,
+    'mvm': bench_mvm,
+    'weight_avg': bench_weight_avg,
+    'quantization': bench_quantization,
+    'pooling': bench_pooling,
+    'pooling2d': bench_pooling2d,
+    'post_mvm': bench_post_mvm,
+}
+
+
+def run_benchmarks(kernels = None, scales = SCALES, repeat = 5, seed = 0):
+    results = dict(meta = dict(time = datetime.datetime.now().isoformat(timespec = 'seconds'),
+                               python = platform.python_version(), numpy = np.__version__,
+                               machine = platform.machine(), repeat = repeat, seed = seed),
+                   results = {})
+    for kernel in kernels or KERNELS:
+        results['results'][kernel] = {}
+        for scale in scales:
+            rng = np.random.default_rng(seed)
+            for layer, r in KERNELS[kernel](scale, rng, repeat).items():
+                results['results'][kernel][f'{layer}@{scale}x'] = r
+    return results
+
+
+def print_results(results):
+    for kernel, cases in results['results'].items():
+        print(f'# {kernel}')
+        print(f'{"case":<14}{"impl":<12}{"time (ms)":>12}{"peak (MB)":>12}{"speedup":>10}{"exact":>8}')
+        for case, r in cases.items():
+            for impl, m in r.items():
+                if not isinstance(m, dict) or 'time' not in m:
+                    continue
+                speedup = f'{r["speedup"][impl]:>9.1f}x' if impl in r['speedup'] else f'{"-":>10}'
+                exact = str(r['exact'][impl]) if impl in r['exact'] else '-'
+                print(f'{case:<14}{impl:<12}{m["time"] * 1e3:>12.3f}{m["peak_memory"] / 2 ** 20:>12.2f}'
+                      f'{speedup}{exact:>8}')
+        print('')
+
+
+def mismatches(results):
+    return [f'{kernel}/{case}/{impl}' for kernel, cases in results['results'].items()
+            for case, r in cases.items() for impl, ok in r['exact'].items() if not ok]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--kernels', nargs = '+', choices = list(KERNELS), default = None)
+    parser.add_argument('--scales', nargs = '+', type = int, default = SCALES)
+    parser.add_argument('--repeat', type = int, default = 5)
+    parser.add_argument('--seed', type = int, default = 0)
+    parser.add_argument('--json', default = None, help = '结果写入的 JSON 文件')
+    args = parser.parse_args()
+
+    results = run_benchmarks(args.kernels, args.scales, args.repeat, args.seed)
+    print_results(results)
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent = 2)
+    failed = mismatches(results)
+    if failed:
+        print('与参考实现不一致: ' + ', '.join(failed))
+        sys.exit(1)
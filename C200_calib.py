@@ -0,0 +1,199 @@
+# =============================== #
+# @File    : C200_calib.py
+# 静态量化校准: 先用一组校准图片跑一遍网络, 记录每层输入 / 输出的绝对值统计
+# (每个通道的最大值和固定 bin 数的直方图), 由此得到每层 (可选每个输出通道) 的量化 scale 并保存;
+# 推理时各层用固定的 scale 做 乘 -> round -> 截断, 不再对每次调用的数据求最大值,
+# 结果也不再依赖同一个 batch 里的其他图片
+#
+# 用法:
+#   from C200_calib import calibrator
+#   calibrator.calibrate()
+#   for img in calib_imgs:
+#       forward(sdk, img)                   # 各层需要传入不同的 name, 例如 conv2d_144k(..., name = 'conv1')
+#   calibrator.finish(method = 'percentile', percentile = 99.99)
+#   # 或只对最后一层 (输出不再进入其他层) 的输出按通道计算 scale:
+#   # calibrator.finish(method = 'percentile', per_channel = ['fc'])
+#   calibrator.save('calib.json')
+#   ...
+#   calibrator.load('calib.json')           # 之后的 conv2d_* / linear_* 使用静态 scale
+# =============================== #
+import json
+import threading
+import numpy as np
+from C200_profile import profiler
+
+HIST_BINS = 2048
+
+
+class Calibrator():
+    def __init__(self, bins = HIST_BINS):
+        # None: 不校准, 按数据动态计算 scale; 'calibrate': 记录统计量; 'static': 使用 scales
+        self.mode = None
+        self.bins = bins
+        # (layer, kind) -> dict(count, max = [C], hist = [C, bins], range)
+        self.layers = {}
+        # (layer, kind) -> float 或每个输出通道一个值的数组
+        self.scales = {}
+        self.config = {}
+        # 校准时各层的调用顺序: layer -> 之后调用的层, 用于判断某层的输出是否进入其他层
+        self.successors = {}
+        self._first = None
+        self._last = None
+        self._lock = threading.Lock()
+
+    def calibrate(self):
+        self.mode = 'calibrate'
+        # 统计量按层记录, 即使不计时也让层函数记录当前层名
+        profiler.require_layers('calibrator')
+
+    def disable(self):
+        self.mode = None
+        profiler.release_layers('calibrator')
+
+    def reset(self):
+        with self._lock:
+            self.layers = {}
+            self.scales = {}
+            self.successors = {}
+            self._first = self._last = None
+
+    def observe(self, layer, kind, data, relu = False, channel_axis = None):
+        # ================================= #
+        # 参数说明
+        # ================================= #
+        # layer, kind:
+        #   层名和 'input' / 'output'
+        # data:
+        #   量化前的数据
+        # relu:
+        #   data 为 relu 之前的数据时, 只统计非负部分
+        # channel_axis:
+        #   输出通道所在的维度, None 时整个张量为一个通道
+        data = np.asarray(data, dtype = np.float64)
+        data = np.maximum(data, 0) if relu else np.abs(data)
+        if channel_axis is None:
+            data = data.reshape(-1, 1)
+        else:
+            data = np.moveaxis(data, channel_axis, -1)
+            data = data.reshape(-1, data.shape[-1])
+        channels = data.shape[1]
+        data_max = data.max(axis = 0)
+        with self._lock:
+            self._follow(layer)
+            entry = self.layers.get((layer, kind))
+            if entry is None:
+                entry = self.layers[(layer, kind)] = dict(
+                    count = 0, max = np.zeros(channels), hist = np.zeros([channels, self.bins], dtype = np.int64),
+                    range = float(data_max.max()) or 1.)
+            elif entry['max'].size != channels:
+                raise ValueError(f'层 {layer} 的 {kind} 通道数 {channels} 与之前的 {entry["max"].size} 不同, '
+                                 f'不同的层需要传入不同的 name')
+            self._grow(entry, float(data_max.max()))
+            bin_index = np.minimum((data * (self.bins / entry['range'])).astype(np.int64), self.bins - 1)
+            bin_index += np.arange(channels)[None, :] * self.bins
+            entry['hist'] += np.bincount(bin_index.ravel(), minlength = channels * self.bins).reshape(channels,
+                                                                                                   self.bins)
+            entry['max'] = np.maximum(entry['max'], data_max)
+            entry['count'] += 1
+
+    # 记录层的调用顺序, 需持有 self._lock
+    def _follow(self, layer):
+        if self._first is None:
+            self._first = layer
+        self.successors.setdefault(layer, set())
+        if self._last is not None and self._last != layer:
+            self.successors[self._last].add(layer)
+        self._last = layer
+
+    def final_layers(self):
+        '''
+        输出不进入其他层的层: 校准时之后只调用过第一层 (下一张图片) 的层
+        多线程 / 流水线校准时不同图片的层交错调用, 只会使判断更保守
+        '''
+        with self._lock:
+            return {layer for layer, after in self.successors.items() if after <= {self._first}}
+
+    # 直方图范围不够时按 2 的幂扩大, 相邻的 bin 合并, 已有的统计不需要原始数据
+    def _grow(self, entry, value):
+        if value <= entry['range']:
+            return
+        factor = 2 ** int(np.ceil(np.log2(value / entry['range'])))
+        hist = entry['hist']
+        merged = np.zeros_like(hist)
+        if factor >= self.bins:
+            merged[:, 0] = hist.sum(axis = 1)
+        else:
+            merged[:, :self.bins // factor] = hist.reshape(hist.shape[0], self.bins // factor, factor).sum(axis = 2)
+        entry['hist'] = merged
+        entry['range'] *= factor
+
+    def finish(self, method = 'max', percentile = 99.99, per_channel = ()):
+        # ================================= #
+        # 参数说明
+        # ================================= #
+        # method:
+        #   'max': scale 为校准数据绝对值的最大值, 与动态量化在校准集上的最大 scale 相同
+        #   'percentile': scale 为绝对值的 percentile 分位数 (按直方图 bin 的上边界), 更大的值被截断
+        # per_channel:
+        #   输出按通道分别计算 scale 的层名列表; 各通道的量化步长不同, 而下一层的权重不会按通道的 scale 比例折算,
+        #   所以只允许输出不再进入其他层的最后一层 (见 final_layers), 其余层的输出每层一个 scale
+        # ===== 返回 =====
+        # scales:
+        #   (layer, kind) -> scale, 之后的推理使用这些 scale
+        if method not in ('max', 'percentile'):
+            raise ValueError(f'不支持的校准方式 {method}')
+        if isinstance(per_channel, (bool, str)):
+            raise ValueError('per_channel 需要是层名列表, 且只能包含输出不再进入其他层的层')
+        per_channel = sorted(per_channel)
+        unknown = [layer for layer in per_channel if (layer, 'output') not in self.layers]
+        if unknown:
+            raise ValueError(f'层 {unknown} 没有校准的输出')
+        feeding = [layer for layer in per_channel if layer not in self.final_layers()]
+        if feeding:
+            raise ValueError(f'层 {feeding} 的输出进入其他层, 不能按通道计算 scale: '
+                             f'下一层的权重没有按通道的 scale 比例折算')
+        scales = {}
+        for key, entry in self.layers.items():
+            hist, data_max = entry['hist'], entry['max']
+            if not (key[1] == 'output' and key[0] in per_channel):
+                hist, data_max = hist.sum(axis = 0, keepdims = True), data_max.max(keepdims = True)
+            if method == 'max':
+                scale = data_max
+            else:
+                cumulative = np.cumsum(hist, axis = 1)
+                target = cumulative[:, -1:] * percentile / 100
+                upper = ((cumulative < target).sum(axis = 1) + 1) * entry['range'] / self.bins
+                scale = np.minimum(upper, data_max)
+            scales[key] = scale.tolist() if scale.size > 1 else float(scale[0])
+        with self._lock:
+            self.scales = scales
+            self.config = dict(method = method, percentile = percentile, per_channel = per_channel)
+        self.mode = 'static'
+        profiler.require_layers('calibrator')
+        return scales
+
+    def scale(self, layer, kind):
+        scale = self.scales.get((layer, kind))
+        if scale is None:
+            raise KeyError(f'层 {layer} 的 {kind} 没有校准的 scale')
+        return scale
+
+    def save(self, path):
+        layers = {}
+        for (layer, kind), scale in self.scales.items():
+            layers.setdefault(layer, {})[kind] = scale
+        with open(path, 'w') as f:
+            json.dump(dict(config = self.config, layers = layers), f, indent = 2)
+
+    def load(self, path):
+        with open(path) as f:
+            data = json.load(f)
+        with self._lock:
+            self.config = data.get('config', {})
+            self.scales = {(layer, kind): scale for layer, kinds in data['layers'].items()
+                           for kind, scale in kinds.items()}
+        self.mode = 'static'
+        profiler.require_layers('calibrator')
+
+
+calibrator = Calibrator()
@@ -0,0 +1,236 @@
+# =============================== #
+# @File    : C200_mapping.py
+# 大尺寸权重的切分与映射: 超过 576 x 128 的权重被切成多个 tile,
+# 分别放到同一芯片的不同区域或多个芯片上, 部分结果在 host 上求和 / 拼接
+# =============================== #
+import numpy as np
+from C200_utils import *
+
+TOTAL_ROWS = 576
+TOTAL_COLS = 128
+
+
+# 把 [rows, cols] 切成不超过 [max_rows, max_cols] 的 tile, 尽量切出满尺寸的 tile, 余下部分单独成 tile
+def split_weight_shape(rows, cols, max_rows = TOTAL_ROWS, max_cols = TOTAL_COLS):
+    # 返回 [(row_start, row_stop, col_start, col_stop), ...], 先行后列
+    row_bounds = list(range(0, rows, max_rows)) + [rows]
+    col_bounds = list(range(0, cols, max_cols)) + [cols]
+    return [(row_bounds[i], row_bounds[i + 1], col_bounds[j], col_bounds[j + 1])
+            for i in range(len(row_bounds) - 1) for j in range(len(col_bounds) - 1)]
+
+
+# 芯片上所有空闲区域, 每个区域为 [chip, row_start, col_start, rows, cols]
+def free_regions(chips = (0,), total_rows = TOTAL_ROWS, total_cols = TOTAL_COLS):
+    return [[chip, 0, 0, total_rows, total_cols] for chip in chips]
+
+
+# 在空闲区域中放置一个 rows x cols 的矩形 (guillotine 切分), 返回 [chip, row_start, col_start, rows, cols]
+def place_rect(free, rows, cols):
+    # 选择能放下的区域中: 芯片编号最小 (减少切换芯片), 其次剩余面积最小
+    candidates = [i for i, (_, _, _, h, w) in enumerate(free) if h >= rows and w >= cols]
+    if not candidates:
+        return None
+    index = min(candidates, key = lambda i: (free[i][0], free[i][3] * free[i][4]))
+    chip, r0, c0, h, w = free.pop(index)
+    # 两种切法中选剩余最大矩形更大的一种
+    #   竖切: 右侧 [h, w - cols], 下方 [h - rows, cols]
+    #   横切: 右侧 [rows, w - cols], 下方 [h - rows, w]
+    if max(h * (w - cols), (h - rows) * cols) >= max(rows * (w - cols), (h - rows) * w):
+        children = [[chip, r0, c0 + cols, h, w - cols], [chip, r0 + rows, c0, h - rows, cols]]
+    else:
+        children = [[chip, r0, c0 + cols, rows, w - cols], [chip, r0 + rows, c0, h - rows, w]]
+    free.extend(child for child in children if child[3] > 0 and child[4] > 0)
+    return [chip, r0, c0, rows, cols]
+
+
+# 切分权重并为每个 tile 分配芯片和地址
+def tile_weight(weight_shape, chips = (0,), free = None, max_rows = TOTAL_ROWS, max_cols = TOTAL_COLS):
+    # ================================= #
+    # 参数说明
+    # ================================= #
+    # weight_shape:
+    #   未复制的权重大小 [rows, cols]
+    # chips:
+    #   可用的芯片编号
+    # free:
+    #   可用的空闲区域 (见 free_regions), 为 None 时使用 chips 上的整个阵列;
+    #   传入的列表会被修改, 可以依次为多层分配地址
+    # ===== 返回 =====
+    # tiles:
+    #   每个 tile 一个 dict: rows / cols 为其在原权重中的范围, chip 为芯片编号,
+    #   addr 为 [row_start, col_start, row_count, col_count], repeat 为 [1, 1]
+    if free is None:
+        free = free_regions(chips)
+    rows, cols = weight_shape
+    bounds = split_weight_shape(rows, cols, max_rows, max_cols)
+    tiles = []
+    # 大的 tile 先放
+    for r0, r1, c0, c1 in sorted(bounds, key = lambda b: -(b[1] - b[0]) * (b[3] - b[2])):
+        placed = place_rect(free, r1 - r0, c1 - c0)
+        if placed is None:
+            raise ValueError(f'芯片 {list(chips)} 上没有足够的空间放置 {r1 - r0} x {c1 - c0} 的 tile')
+        chip, row_start, col_start, row_count, col_count = placed
+        tiles.append(dict(rows = (int(r0), int(r1)), cols = (int(c0), int(c1)), chip = chip,
+                          addr = [row_start, col_start, row_count, col_count], repeat = [1, 1]))
+    tiles.sort(key = lambda t: (t['chip'], t['rows'], t['cols']))
+    return tiles
+
+
+# sdks 为单个 SDKArray, 或按芯片编号索引的 dict / list
+def tile_sdk(sdks, tile):
+    if isinstance(sdks, (dict, list, tuple)):
+        return sdks[tile['chip']]
+    return sdks
+
+
+# 按 tile 写入权重
+def set_weight_tiled(sdks, weight, tiles, **kwargs):
+    # weight: 未复制的权重映射值 [rows, cols] (0 ~ 15), kwargs 传给 sdk.set_weight
+    for tile in tiles:
+        r0, r1 = tile['rows']
+        c0, c1 = tile['cols']
+        tile_sdk(sdks, tile).set_weight(np.tile(weight[r0:r1, c0:c1], tile['repeat']),
+                                        addr = tile['addr'], **kwargs)
+
+
+# 按 tile 做乘加运算: 行方向的 tile 结果求和, 列方向的 tile 结果拼接
+def mvm_tiled_144k(sdks, input, tiles, it_time = 5):
+    # input: 量化后的输入 [rows, cal_times]
+    # 返回值 shape = [cal_times, cols]
+    cal_times = input.shape[-1]
+    output_cols = max(tile['cols'][1] for tile in tiles)
+    output = np.zeros([cal_times, output_cols])
+    for tile in tiles:
+        r0, r1 = tile['rows']
+        c0, c1 = tile['cols']
+        repeat = tile['repeat']
+        tile_input = input[r0:r1]
+        if repeat[0] > 1:
+            tile_input = np.broadcast_to(tile_input, (repeat[0],) + tile_input.shape)
+        output[:, c0:c1] += mvm_bitwise_concat_push_fast_144k(tile_sdk(sdks, tile), tile_input, tile['addr'],
+                                                              repeat, it_time = it_time)
+    return output
+
+
+# 切分后的全连接层, 与 linear_144k 相同, 但权重可以超过一个阵列
+@profiled_layer('linear_144k_tiled')
+def linear_144k_tiled(sdks, input_feature_map, tiles,
+                      input_half_level, output_half_level,
+                      it_time = 10,
+                      relu = True,
+                      input_quant = False):
+    # ================================= #
+    # 参数说明
+    # ================================= #
+    # sdks:
+    #   SDKArray, 或按芯片编号索引的 SDKArray dict / list
+    # tiles:
+    #   tile_weight 的返回值
+    # 其余参数同 linear_144k
+    array_input = input_feature_map.reshape(-1, 1)
+    if input_quant:
+        array_input = layer_quantization(array_input, input_half_level, 'input')
+
+    array_output = mvm_tiled_144k(sdks, array_input, tiles, it_time = it_time)
+    if relu:
+        array_output[array_output < 0] = 0
+    array_output = layer_quantization(array_output, output_half_level, 'output', channel_axis = -1)
+
+    return array_output
+
+
+# 切分后的卷积层, 与 conv2d_144k 相同, 但权重可以超过一个阵列
+@profiled_layer('conv2d_144k_tiled')
+def conv2d_144k_tiled(sdks, input_feature_map, tiles,
+                      stride, kernel_size, padding,
+                      input_half_level, output_half_level,
+                      it_time = 10,
+                      relu = True,
+                      input_quant = False,
+                      pool = None,
+                      pool_first = True):
+    # 参数同 conv2d_144k 与 linear_144k_tiled
+    while len(input_feature_map.shape) < 3:
+        input_feature_map = np.expand_dims(input_feature_map, axis = 0)
+    _, input_rows, input_cols = input_feature_map.shape
+    out_feature_size_rows = int((input_rows + 2 * padding - kernel_size) / stride + 1)
+    out_feature_size_cols = int((input_cols + 2 * padding - kernel_size) / stride + 1)
+
+    if input_quant:
+        input_feature_map = layer_quantization(input_feature_map, input_half_level, 'input')
+    array_input = feature_map_to_input(input_feature_map, stride = stride, kernel_size = kernel_size,
+                                       padding = padding)
+    array_output = mvm_tiled_144k(sdks, array_input, tiles, it_time = it_time)
+
+    scale = calibration_scale(array_output, 'output', relu = relu, channel_axis = -1)
+    return post_mvm_fused(array_output, out_feature_size_rows, out_feature_size_cols, output_half_level,
+                          relu = relu, pool = pool, pool_first = pool_first, scale = scale)
+
+
+# 按给定顺序尝试放置所有矩形, 全部放下时返回每个矩形的位置, 否则返回 None
+def pack_rects(shapes, chips = (0,), total_rows = TOTAL_ROWS, total_cols = TOTAL_COLS):
+    # 依次尝试按面积 / 行数 / 列数从大到小放置, 任一顺序成功即返回
+    orders = [lambda i: -shapes[i][0] * shapes[i][1],
+              lambda i: (-shapes[i][0], -shapes[i][1]),
+              lambda i: (-shapes[i][1], -shapes[i][0])]
+    for order in orders:
+        free = free_regions(chips, total_rows, total_cols)
+        placed = [None] * len(shapes)
+        for i in sorted(range(len(shapes)), key = order):
+            placed[i] = place_rect(free, *shapes[i])
+            if placed[i] is None:
+                break
+        else:
+            return placed
+    return None
+
+
+# 多层权重的放置规划: 所有层放到不重叠的区域上, 并在剩余空间中尽量增大各层的复制次数
+def plan_placement(layers, chips = (0,), total_rows = TOTAL_ROWS, total_cols = TOTAL_COLS):
+    # ================================= #
+    # 参数说明
+    # ================================= #
+    # layers:
+    #   dict, 层名 -> dict(shape = [rows, cols], min_repeat = [1, 1], max_repeat = None)
+    #   shape 为未复制的权重大小, min_repeat / max_repeat 为复制次数的下限 / 上限 (可选)
+    # chips:
+    #   可用的芯片编号
+    # ===== 返回 =====
+    # placement:
+    #   dict, 层名 -> dict(chip, addr, repeat), addr 为复制后权重的 [row_start, col_start, rows, cols],
+    #   可直接作为 conv2d_144k / linear_144k 的 weight_addr 和 repeat
+    names = list(layers)
+    shapes = [layers[name]['shape'] for name in names]
+    repeats = [list(layers[name].get('min_repeat', [1, 1])) for name in names]
+    max_repeats = []
+    for (rows, cols), name in zip(shapes, names):
+        max_repeat = layers[name].get('max_repeat') or [total_rows // rows, total_cols // cols]
+        max_repeats.append([min(max_repeat[0], total_rows // rows), min(max_repeat[1], total_cols // cols)])
+
+    def footprints(repeats):
+        return [[rows * r[0], cols * r[1]] for (rows, cols), r in zip(shapes, repeats)]
+
+    placed = pack_rects(footprints(repeats), chips, total_rows, total_cols)
+    if placed is None:
+        raise ValueError(f'芯片 {list(chips)} 上放不下所有层, 大于 {total_rows} x {total_cols} 的层请先用 tile_weight 切分')
+
+    # 贪心增大复制次数: 每次选当前复制总数最少的层, 行复制优先, 放不下的候选不再尝试
+    candidates = {(i, axis) for i in range(len(names)) for axis in (0, 1)}
+    while candidates:
+        i, axis = min(candidates, key = lambda c: (repeats[c[0]][0] * repeats[c[0]][1], c[1],
+                                                   shapes[c[0]][1 - c[1]]))
+        if repeats[i][axis] >= max_repeats[i][axis]:
+            candidates.discard((i, axis))
+            continue
+        trial = [list(r) for r in repeats]
+        trial[i][axis] += 1
+        trial_placed = pack_rects(footprints(trial), chips, total_rows, total_cols)
+        if trial_placed is None:
+            candidates.discard((i, axis))
+            continue
+        repeats, placed = trial, trial_placed
+
+    placement = {}
+    for name, repeat, (chip, row_start, col_start, rows, cols) in zip(names, repeats, placed):
+        placement[name] = dict(chip = chip, addr = [row_start, col_start, rows, cols], repeat = repeat)
+    return placement
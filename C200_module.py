@@ -10,23 +10,25 @@ import matplotlib.pyplot as plt
 # ======================= #
 # 函数形式计算层
 # ======================= #
+# 各层函数都可以传入关键字参数 name, 开启 C200_profile.profiler 后按 name 分层统计各步骤耗时
 # 池化 fast
-def pooling(feature_map, kernel_size):
-    channels = feature_map.shape[0]
-    pooled_rows = int(feature_map.shape[1] / kernel_size)
-    pooled_cols = int(feature_map.shape[2] / kernel_size)
-    output = feature_map.reshape(channels, pooled_rows, kernel_size, pooled_cols, kernel_size)
-    output = output.max(axis = (2, 4))
-    return output
+def pooling(feature_map, kernel_size, stride = None, padding = 0, mode = 'max', ceil_mode = False):
+    # feature_map shape = [C, H, W] 或 [N, C, H, W]
+    # 默认为不重叠的最大池化, 不能整除的行列被舍去; 其余参数见 C200_utils.pooling2d
+    return pooling2d(feature_map, kernel_size, stride = stride, padding = padding, mode = mode,
+                     ceil_mode = ceil_mode)
 
 
 # 144k 片上推理卷积封装 函数形式
+@profiled_layer('conv2d_144k')
 def conv2d_144k(sdk, input_feature_map, weight_addr, repeat,
                 stride, kernel_size, padding,
                 input_half_level, output_half_level,
                 it_time = 10,
                 relu = True,
-                input_quant = False):
+                input_quant = False,
+                pool = None,
+                pool_first = True):
     # ================================= #
     # 参数说明
     # ================================= #
@@ -46,6 +48,10 @@ def conv2d_144k(sdk, input_feature_map, weight_addr, repeat,
     #   是否 relu
     # input_quant:
     #   是否对输入数据进行量化
+    # pool, pool_first:
+    #   输出的池化参数 (None 时不池化, int 为最大池化的 kernel_size, dict 为 pooling2d 的参数)
+    #   和是否先池化再量化, 与 relu / 量化一起融合计算, 最大池化的结果与调用 pooling(conv2d_144k(...), pool) 相同,
+    #   见 post_mvm_fused
 
     # 补齐维度
     while len(input_feature_map.shape) < 3:
@@ -57,25 +63,20 @@ def conv2d_144k(sdk, input_feature_map, weight_addr, repeat,
 
     # 输入数据量化
     if input_quant:
-        input_feature_map, _ = data_quantization_sym(input_feature_map, half_level = input_half_level,
-                                                     isint = 1)
+        input_feature_map = layer_quantization(input_feature_map, input_half_level, 'input')
     # 输入图像重排
     array_input = feature_map_to_input(input_feature_map, stride = stride, kernel_size = kernel_size,
-                                       padding = padding, repeat = repeat)
+                                       padding = padding, repeat = repeat, lazy = True)
     # 乘加运算(卷积 f1), 使用脉冲展开
     array_output = mvm_bitwise_concat_push_fast_144k(sdk, array_input, weight_addr, repeat, it_time = it_time)
-    # Relu
-    if relu:
-        array_output[array_output < 0] = 0
-    # 数据量化
-    array_output, _ = data_quantization_sym(array_output, half_level = output_half_level, isint = 1)
-    # 数据重排
-    array_output = output_to_feature_map(array_output, out_feature_size_rows, out_feature_size_cols)
-
-    return array_output
+    scale = calibration_scale(array_output, 'output', relu = relu, channel_axis = -1)
+    # Relu, 数据量化, 池化, 数据重排
+    return post_mvm_fused(array_output, out_feature_size_rows, out_feature_size_cols, output_half_level,
+                          relu = relu, pool = pool, pool_first = pool_first, scale = scale)
 
 
 # 144k 片上推理全连接封装 函数形式
+@profiled_layer('linear_144k')
 def linear_144k(sdk, input_feature_map, weight_addr, repeat,
                 input_half_level, output_half_level,
                 it_time = 10,
@@ -100,25 +101,105 @@ def linear_144k(sdk, input_feature_map, weight_addr, repeat,
     #   是否对输入数据进行量化
     array_input = input_feature_map.reshape(-1, 1)
     if input_quant:
-        array_input, _ = data_quantization_sym(array_input, half_level = input_half_level, isint = 1)
+        array_input = layer_quantization(array_input, input_half_level, 'input')
     array_input = np.tile(array_input, [repeat[0], 1])
 
     array_output = mvm_bitwise_concat_push_fast_144k(sdk, array_input, weight_addr, repeat, it_time = it_time)
     if relu:
         array_output[array_output < 0] = 0
-    array_output, _ = data_quantization_sym(array_output, half_level = output_half_level, isint = 1)
+    array_output = layer_quantization(array_output, output_half_level, 'output', channel_axis = -1)
 
     return array_output
 
 
 
+# 144k 片上推理卷积封装 batch 形式
+@profiled_layer('conv2d_144k_batch')
+def conv2d_144k_batch(sdk, input_feature_map, weight_addr, repeat,
+                      stride, kernel_size, padding,
+                      input_half_level, output_half_level,
+                      it_time = 10,
+                      relu = True,
+                      input_quant = False,
+                      max_pulses = MAX_PULSES_PER_CALL,
+                      pool = None,
+                      pool_first = True):
+    # ================================= #
+    # 参数说明
+    # ================================= #
+    # input_feature_map:
+    #   输入 feature map, 矩阵大小为 [N, C, H, W]
+    # max_pulses:
+    #   单次 sdk.calculate 的最大脉冲数, 所有图片的脉冲合并后按该值分批上片
+    # 其余参数与 conv2d_144k 相同, 输入/输出量化均按每张图片分别计算 scale,
+    # 返回值大小为 [N, C_out, H_out, W_out], 与逐张调用 conv2d_144k 的结果相同
+
+    # 补齐维度
+    while len(input_feature_map.shape) < 4:
+        input_feature_map = np.expand_dims(input_feature_map, axis = 1)
+    # 计算输出大小
+    batch_size, _, input_rows, input_cols = input_feature_map.shape
+    out_feature_size_rows = int((input_rows + 2 * padding - kernel_size) / stride + 1)
+    out_feature_size_cols = int((input_cols + 2 * padding - kernel_size) / stride + 1)
+
+    # 输入数据量化
+    if input_quant:
+        input_feature_map = layer_quantization(input_feature_map, input_half_level, 'input', batch = True)
+    # 输入图像重排, array_input shape = [N, repeat[0], rows, W_out * H_out]
+    array_input = feature_map_to_input(input_feature_map, stride = stride, kernel_size = kernel_size,
+                                       padding = padding, repeat = repeat, lazy = True)
+    # 乘加运算, 所有图片合并上片
+    array_output = mvm_bitwise_concat_push_fast_144k_batch(sdk, array_input, weight_addr, repeat,
+                                                           it_time = it_time, max_pulses = max_pulses)
+    scale = calibration_scale(array_output, 'output', relu = relu, channel_axis = -1)
+    # Relu, 数据量化 (每张图片分别计算 scale), 池化, 数据重排 [N, W_out * H_out, C_out] -> [N, C_out, W_out, H_out]
+    return post_mvm_fused(array_output, out_feature_size_rows, out_feature_size_cols, output_half_level,
+                          relu = relu, pool = pool, pool_first = pool_first, scale = scale)
+
+
+# 144k 片上推理全连接封装 batch 形式
+@profiled_layer('linear_144k_batch')
+def linear_144k_batch(sdk, input_feature_map, weight_addr, repeat,
+                      input_half_level, output_half_level,
+                      it_time = 10,
+                      relu = True,
+                      input_quant = False,
+                      max_pulses = MAX_PULSES_PER_CALL):
+    # ================================= #
+    # 参数说明
+    # ================================= #
+    # input_feature_map:
+    #   输入 feature map, 矩阵大小为 [N, ...], 每张图片展平后作为一列输入
+    # max_pulses:
+    #   单次 sdk.calculate 的最大脉冲数, 所有图片的脉冲合并后按该值分批上片
+    # 其余参数与 linear_144k 相同, 返回值大小为 [N, C_out]
+    batch_size = input_feature_map.shape[0]
+    array_input = input_feature_map.reshape(batch_size, -1, 1)
+    if input_quant:
+        array_input = layer_quantization(array_input, input_half_level, 'input', batch = True)
+    array_input = np.broadcast_to(array_input[:, None], (batch_size, repeat[0]) + array_input.shape[1:])
+
+    array_output = mvm_bitwise_concat_push_fast_144k_batch(sdk, array_input, weight_addr, repeat,
+                                                           it_time = it_time, max_pulses = max_pulses)
+    array_output = array_output.reshape(batch_size, -1)
+    if relu:
+        array_output[array_output < 0] = 0
+    array_output = layer_quantization(array_output, output_half_level, 'output', batch = True, channel_axis = -1)
+
+    return array_output
+
+
 # 144k 片上推理卷积封装 函数形式
+@profiled_layer('conv2d_sim')
 def conv2d_sim(sdk, input_feature_map, weights, repeat,
                 stride, kernel_size, padding,
                 input_half_level, output_half_level,
                 it_time = 10,
                 relu = True,
-                input_quant = False):
+                input_quant = False,
+                ideal = False,
+                pool = None,
+                pool_first = True):
     # ================================= #
     # 参数说明
     # ================================= #
@@ -138,6 +219,10 @@ def conv2d_sim(sdk, input_feature_map, weights, repeat,
     #   是否 relu
     # input_quant:
     #   是否对输入数据进行量化
+    # ideal:
+    #   理想 ADC 仿真, 跳过 bitwise 展开直接计算矩阵乘
+    # pool, pool_first:
+    #   同 conv2d_144k
 
     # 补齐维度
     while len(input_feature_map.shape) < 3:
@@ -149,30 +234,26 @@ def conv2d_sim(sdk, input_feature_map, weights, repeat,
 
     # 输入数据量化
     if input_quant:
-        input_feature_map, _ = data_quantization_sym(input_feature_map, half_level = input_half_level,
-                                                     isint = 1)
+        input_feature_map = layer_quantization(input_feature_map, input_half_level, 'input')
     # 输入图像重排
     array_input = feature_map_to_input(input_feature_map, stride = stride, kernel_size = kernel_size,
-                                       padding = padding, repeat = repeat)
+                                       padding = padding, repeat = repeat, lazy = True)
     # 模拟乘加运算
-    array_output = mvm_bitwise_concat_push_fast(array_input, weights, repeat)
-    # Relu
-    if relu:
-        array_output[array_output < 0] = 0
-    # 数据量化
-    array_output, _ = data_quantization_sym(array_output, half_level = output_half_level, isint = 1)
-    # 数据重排
-    array_output = output_to_feature_map(array_output, out_feature_size_rows, out_feature_size_cols)
-
-    return array_output
+    array_output = mvm_bitwise_concat_push_fast(array_input, weights, repeat, ideal = ideal)
+    scale = calibration_scale(array_output, 'output', relu = relu, channel_axis = -1)
+    # Relu, 数据量化, 池化, 数据重排
+    return post_mvm_fused(array_output, out_feature_size_rows, out_feature_size_cols, output_half_level,
+                          relu = relu, pool = pool, pool_first = pool_first, scale = scale)
 
 
 # 144k 片上推理全连接封装 函数形式
+@profiled_layer('linear_sim')
 def linear_sim(sdk, input_feature_map, weights, repeat,
                 input_half_level, output_half_level,
                 it_time = 10,
                 relu = True,
-                input_quant = False):
+                input_quant = False,
+                ideal = False):
     # ================================= #
     # 参数说明
     # ================================= #
@@ -190,14 +271,96 @@ def linear_sim(sdk, input_feature_map, weights, repeat,
     #   是否 relu
     # input_quant:
     #   是否对输入数据进行量化
+    # ideal:
+    #   理想 ADC 仿真, 跳过 bitwise 展开直接计算矩阵乘
     array_input = input_feature_map.reshape(-1, 1)
     if input_quant:
-        array_input, _ = data_quantization_sym(array_input, half_level = input_half_level, isint = 1)
+        array_input = layer_quantization(array_input, input_half_level, 'input')
     array_input = np.tile(array_input, [repeat[0], 1])
 
-    array_output = mvm_bitwise_concat_push_fast(array_input, weights, repeat)
+    array_output = mvm_bitwise_concat_push_fast(array_input, weights, repeat, ideal = ideal)
     if relu:
         array_output[array_output < 0] = 0
-    array_output, _ = data_quantization_sym(array_output, half_level = output_half_level, isint = 1)
+    array_output = layer_quantization(array_output, output_half_level, 'output', channel_axis = -1)
+
+    return array_output
+
+
+# CPU 仿真卷积封装 batch 形式
+@profiled_layer('conv2d_sim_batch')
+def conv2d_sim_batch(sdk, input_feature_map, weights, repeat,
+                     stride, kernel_size, padding,
+                     input_half_level, output_half_level,
+                     it_time = 10,
+                     relu = True,
+                     input_quant = False,
+                     ideal = False,
+                     per_sample_scale = True,
+                     pool = None,
+                     pool_first = True):
+    # ================================= #
+    # 参数说明
+    # ================================= #
+    # input_feature_map:
+    #   输入 feature map, 矩阵大小为 [N, C, H, W]
+    # per_sample_scale:
+    #   True 时输入/输出量化对每张图片分别计算 scale, 结果与逐张调用 conv2d_sim 相同;
+    #   False 时整个 batch 共用一个 scale
+    # 其余参数与 conv2d_sim 相同, 返回值大小为 [N, C_out, H_out, W_out]
+
+    # 补齐维度
+    while len(input_feature_map.shape) < 4:
+        input_feature_map = np.expand_dims(input_feature_map, axis = 1)
+    # 计算输出大小
+    batch_size, _, input_rows, input_cols = input_feature_map.shape
+    out_feature_size_rows = int((input_rows + 2 * padding - kernel_size) / stride + 1)
+    out_feature_size_cols = int((input_cols + 2 * padding - kernel_size) / stride + 1)
 
-    return array_output
\ No newline at end of file
+    # 输入数据量化
+    if input_quant:
+        input_feature_map = layer_quantization(input_feature_map, input_half_level, 'input', batch = True,
+                                               per_sample = per_sample_scale)
+    # 输入图像重排, array_input shape = [N, repeat[0], rows, W_out * H_out]
+    array_input = feature_map_to_input(input_feature_map, stride = stride, kernel_size = kernel_size,
+                                       padding = padding, repeat = repeat, lazy = True)
+    # 模拟乘加运算
+    array_output = mvm_bitwise_concat_push_fast_batch(array_input, weights, repeat, ideal = ideal)
+    scale = calibration_scale(array_output, 'output', relu = relu, channel_axis = -1)
+    # Relu, 数据量化, 池化, 数据重排 [N, W_out * H_out, C_out] -> [N, C_out, W_out, H_out]
+    return post_mvm_fused(array_output, out_feature_size_rows, out_feature_size_cols, output_half_level,
+                          relu = relu, pool = pool, pool_first = pool_first, scale = scale,
+                          per_sample = per_sample_scale)
+
+
+# CPU 仿真全连接封装 batch 形式
+@profiled_layer('linear_sim_batch')
+def linear_sim_batch(sdk, input_feature_map, weights, repeat,
+                     input_half_level, output_half_level,
+                     it_time = 10,
+                     relu = True,
+                     input_quant = False,
+                     ideal = False,
+                     per_sample_scale = True):
+    # ================================= #
+    # 参数说明
+    # ================================= #
+    # input_feature_map:
+    #   输入 feature map, 矩阵大小为 [N, ...], 每张图片展平后作为一列输入
+    # per_sample_scale:
+    #   True 时输入/输出量化对每张图片分别计算 scale, False 时整个 batch 共用一个 scale
+    # 其余参数与 linear_sim 相同, 返回值大小为 [N, C_out]
+    batch_size = input_feature_map.shape[0]
+    array_input = input_feature_map.reshape(batch_size, -1, 1)
+    if input_quant:
+        array_input = layer_quantization(array_input, input_half_level, 'input', batch = True,
+                                         per_sample = per_sample_scale)
+    array_input = np.broadcast_to(array_input[:, None], (batch_size, repeat[0]) + array_input.shape[1:])
+
+    array_output = mvm_bitwise_concat_push_fast_batch(array_input, weights, repeat, ideal = ideal)
+    array_output = array_output.reshape(batch_size, -1)
+    if relu:
+        array_output[array_output < 0] = 0
+    array_output = layer_quantization(array_output, output_half_level, 'output', batch = True,
+                                      per_sample = per_sample_scale, channel_axis = -1)
+
+    return array_output
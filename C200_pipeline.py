@@ -0,0 +1,159 @@
+# =============================== #
+# @File    : C200_pipeline.py
+# 流水线推理: 芯片计算第 i 张图时, 另一线程在 host 上准备第 i+1 张图的输入
+# elemem_calc_array 是阻塞的 ctypes 调用, 调用期间释放 GIL, host 计算可以与之重叠
+# =============================== #
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from C200_module import *
+from C200_profile import profiler
+
+# 不计入 host 各步骤的 span: 层总时间和芯片调用 (芯片时间由 TimedSDK 统计)
+NON_HOST_SPANS = ('total', 'mvm_chip')
+
+
+# 带锁和计时的 sdk 包装: 保证同一时刻只有一个线程在用芯片, 并统计芯片忙碌时间
+class TimedSDK():
+    def __init__(self, sdk, lock = None):
+        self.sdk = sdk
+        self.lock = lock if lock is not None else threading.Lock()
+        self._stats_lock = threading.Lock()
+        self.reset_stats()
+
+    def reset_stats(self):
+        self.stats = dict(chip_busy = 0., chip_wait = 0., chip_calls = 0)
+
+    def calculate(self, *args, **kwargs):
+        t_wait = time.perf_counter()
+        with self.lock:
+            t_start = time.perf_counter()
+            output = self.sdk.calculate(*args, **kwargs)
+            t_end = time.perf_counter()
+        with self._stats_lock:
+            self.stats['chip_wait'] += t_start - t_wait
+            self.stats['chip_busy'] += t_end - t_start
+            self.stats['chip_calls'] += 1
+        return output
+
+    def __getattr__(self, name):
+        return getattr(self.sdk, name)
+
+
+# 由层描述生成单张图片的前向函数
+def sequential_forward(layers):
+    # ================================= #
+    # 参数说明
+    # ================================= #
+    # layers:
+    #   每层一个 dict, 'type' 为 'conv2d' 或 'linear', 'pool' 为可选的池化参数 (见 post_mvm_fused, conv2d 层与输出量化融合计算),
+    #   其余键作为参数传给 conv2d_144k / linear_144k, 例如
+    #   dict(type = 'conv2d', weight_addr = addr_f1, repeat = f1_repeat, stride = 1, kernel_size = 3,
+    #        padding = 1, input_half_level = 7, output_half_level = 15, it_time = 3, input_quant = True, pool = 2)
+    layer_funcs = {'conv2d': conv2d_144k, 'linear': linear_144k}
+
+    def forward(sdk, img):
+        x = img
+        for layer in layers:
+            kwargs = dict(layer)
+            func = layer_funcs[kwargs.pop('type')]
+            pool = kwargs.pop('pool', None)
+            if pool and func is conv2d_144k:
+                x = func(sdk, x, pool = pool, **kwargs)
+                continue
+            x = func(sdk, x, **kwargs)
+            if pool:
+                x = pooling2d(x, **pool) if isinstance(pool, dict) else pooling(x, pool)
+        return x
+
+    return forward
+
+
+# profiler 中各 span 的总时间 (各层之和)
+def _span_totals(records):
+    totals = {}
+    for (_, name), (_, total) in list(records.items()):
+        if name not in NON_HOST_SPANS:
+            totals[name] = totals.get(name, 0.) + total
+    return totals
+
+
+# 流水线推理
+def pipeline_inference(sdk, forward, imgs, workers = 2, stages = True):
+    # ================================= #
+    # 参数说明
+    # ================================= #
+    # sdk:
+    #   SDKArray 实例, 或任何提供 calculate 的对象
+    # forward:
+    #   单张图片的前向函数 forward(sdk, img), 例如 sequential_forward 的返回值
+    # imgs:
+    #   图片序列
+    # workers:
+    #   同时处理的图片数, 1 为串行执行
+    # stages:
+    #   用 C200_profile 的 span 统计 host 上各步骤 (im2col, quantization, expansion, regroup, post_mvm, ...)
+    #   的时间; profiler 未开启时只在本次运行中临时开启, 不改变已有的记录
+    # ===== 返回 =====
+    # outputs:
+    #   每张图片的输出, 顺序与 imgs 相同
+    # stats:
+    #   wall / chip_busy / chip_wait / host_busy 为秒数,
+    #   chip_util / host_util 为芯片和 host 线程忙碌时间占总时间的比例 (host_util 可以超过 1),
+    #   stages 为 host 各步骤的 dict(busy, util); post_mvm 包含其中融合的池化, 与 pooling 有重叠
+    timed_sdk = sdk if isinstance(sdk, TimedSDK) else TimedSDK(sdk)
+    timed_sdk.reset_stats()
+    thread_time = []
+    thread_time_lock = threading.Lock()
+
+    def run_one(img):
+        t = time.perf_counter()
+        output = forward(timed_sdk, img)
+        with thread_time_lock:
+            thread_time.append(time.perf_counter() - t)
+        return output
+
+    profiler_was_enabled = profiler.enabled
+    if stages and not profiler_was_enabled:
+        saved_records = profiler.records
+        profiler.records = {}
+        profiler.enable()
+    span_start = _span_totals(profiler.records) if stages else {}
+
+    t_start = time.perf_counter()
+    try:
+        if workers <= 1:
+            outputs = [run_one(img) for img in imgs]
+        else:
+            with ThreadPoolExecutor(max_workers = workers) as executor:
+                outputs = list(executor.map(run_one, imgs))
+    finally:
+        wall = time.perf_counter() - t_start
+        span_end = _span_totals(profiler.records) if stages else {}
+        if stages and not profiler_was_enabled:
+            profiler.disable()
+            profiler.records = saved_records
+
+    stats = dict(timed_sdk.stats)
+    stats['wall'] = wall
+    stats['images'] = len(outputs)
+    # host 时间 = 线程总时间 - 芯片计算时间 - 等待芯片的时间
+    stats['host_busy'] = sum(thread_time) - stats['chip_busy'] - stats['chip_wait']
+    stats['chip_util'] = stats['chip_busy'] / wall if wall > 0 else 0.
+    stats['host_util'] = stats['host_busy'] / wall if wall > 0 else 0.
+    stats['stages'] = {}
+    for name, total in sorted(span_end.items(), key = lambda kv: -kv[1]):
+        busy = total - span_start.get(name, 0.)
+        stats['stages'][name] = dict(busy = busy, util = busy / wall if wall > 0 else 0.)
+    return outputs, stats
+
+
+def print_pipeline_stats(stats):
+    print(f'images = {stats["images"]}, wall = {stats["wall"]:.3f}s, '
+          f'{stats["wall"] / max(stats["images"], 1) * 1e3:.2f} ms/img')
+    print(f'{"stage":<16}{"busy (s)":>12}{"util":>10}')
+    print(f'{"chip":<16}{stats["chip_busy"]:>12.3f}{stats["chip_util"]:>9.1%}')
+    print(f'{"host":<16}{stats["host_busy"]:>12.3f}{stats["host_util"]:>9.1%}')
+    for name, stage in stats.get('stages', {}).items():
+        print(f'{"  " + name:<16}{stage["busy"]:>12.3f}{stage["util"]:>9.1%}')
+    print(f'{"wait":<16}{stats["chip_wait"]:>12.3f}')
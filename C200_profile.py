@@ -0,0 +1,181 @@
+# =============================== #
+# @File    : C200_profile.py
+# 分层计时: C200_utils / C200_module 中的各步骤 (im2col, 量化, 展开, 上片/仿真乘加, 求和, 复制平均, 池化)
+# 以具名 span 计时, 按层汇总, 运行后以表格查看
+# 关闭时 (默认) 每个 span 只多一次函数调用和一次判断
+#
+# 用法:
+#   from C200_profile import profiler
+#   profiler.enable()
+#   conv1_out = conv2d_144k(sdk, img, ..., name = 'conv1')
+#   ...
+#   profiler.print_table()
+# =============================== #
+import time
+import threading
+import functools
+from contextlib import contextmanager
+
+
+# 关闭时使用的空 span, 全局只有一个实例
+class _NullSpan():
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+_NULL_SPAN = _NullSpan()
+
+
+class _Span():
+    __slots__ = ('profiler', 'name', 'start', 'active')
+
+    def __init__(self, profiler, name):
+        self.profiler = profiler
+        self.name = name
+
+    def __enter__(self):
+        local = self.profiler._local
+        active = getattr(local, 'active', None)
+        if active is None:
+            active = local.active = set()
+        # 同名 span 嵌套时只计外层, 避免重复计时
+        self.active = self.name not in active
+        if self.active:
+            active.add(self.name)
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        elapsed = time.perf_counter() - self.start
+        if self.active:
+            self.profiler._local.active.discard(self.name)
+            self.profiler.record(self.name, elapsed)
+        return False
+
+
+class Profiler():
+    def __init__(self):
+        self.enabled = False
+        # 不计时但需要当前层名的使用者 (C200_stats, C200_calib), 各自登记 / 注销, 互不影响
+        self._layer_users = set()
+        # (layer, span) -> [count, total seconds]
+        self.records = {}
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    def enable(self):
+        self.enabled = True
+
+    def disable(self):
+        self.enabled = False
+
+    def reset(self):
+        with self._lock:
+            self.records = {}
+
+    # 是否需要记录当前层名: 有任一使用者登记时为 True
+    @property
+    def track_layers(self):
+        return bool(self._layer_users)
+
+    def require_layers(self, user):
+        with self._lock:
+            self._layer_users.add(user)
+
+    def release_layers(self, user):
+        with self._lock:
+            self._layer_users.discard(user)
+
+    def current_layer(self):
+        return getattr(self._local, 'layer', None)
+
+    def current_layer_named(self):
+        # 当前层名是否由调用者显式给出 (而不是层函数的默认名)
+        return getattr(self._local, 'layer_named', False)
+
+    def record(self, name, elapsed, layer = None):
+        key = (layer if layer is not None else self.current_layer(), name)
+        with self._lock:
+            entry = self.records.get(key)
+            if entry is None:
+                self.records[key] = [1, elapsed]
+            else:
+                entry[0] += 1
+                entry[1] += elapsed
+
+    def span(self, name):
+        if not self.enabled:
+            return _NULL_SPAN
+        return _Span(self, name)
+
+    @contextmanager
+    def layer(self, name, named = True):
+        # 在 with 块内记录的 span 都归到层 name 下, 层本身的总时间记为 span 'total'
+        # named: name 是否由调用者显式给出, 为 False 时 name 是层函数的默认名, 同一函数的不同层会重名
+        if not self.enabled and not self.track_layers:
+            yield
+            return
+        previous, previous_named = self.current_layer(), self.current_layer_named()
+        self._local.layer, self._local.layer_named = name, named
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self._local.layer, self._local.layer_named = previous, previous_named
+            if self.enabled:
+                self.record('total', time.perf_counter() - start, layer = name)
+
+    def table(self):
+        # 返回 [dict(layer, span, count, total, mean, share), ...], share 为占该层 total 的比例
+        layer_total = {layer: total for (layer, name), (_, total) in self.records.items() if name == 'total'}
+        rows = []
+        for (layer, name), (count, total) in sorted(self.records.items(), key = lambda kv: (str(kv[0][0]),
+                                                                                            kv[0][1] != 'total',
+                                                                                            -kv[1][1])):
+            base = layer_total.get(layer)
+            rows.append(dict(layer = layer, span = name, count = count, total = total, mean = total / count,
+                             share = total / base if base else None))
+        return rows
+
+    def print_table(self):
+        print(f'{"layer":<12}{"span":<14}{"count":>8}{"total (ms)":>14}{"mean (ms)":>12}{"share":>9}')
+        for row in self.table():
+            share = f'{row["share"]:>8.1%}' if row['share'] is not None else f'{"-":>8}'
+            print(f'{str(row["layer"]):<12}{row["span"]:<14}{row["count"]:>8}{row["total"] * 1e3:>14.3f}'
+                  f'{row["mean"] * 1e3:>12.3f} {share}')
+
+
+profiler = Profiler()
+
+
+def span(name):
+    return profiler.span(name)
+
+
+# 函数装饰器: 整个函数计为一个 span
+def profiled(name):
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not profiler.enabled:
+                return func(*args, **kwargs)
+            with _Span(profiler, name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+# 层函数装饰器: 增加关键字参数 name, 函数内的 span 归到该层下
+def profiled_layer(default_name):
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, name = None, **kwargs):
+            if not profiler.enabled and not profiler.track_layers:
+                return func(*args, **kwargs)
+            with profiler.layer(name or default_name, named = name is not None):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
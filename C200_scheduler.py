@@ -0,0 +1,70 @@
+# =============================== #
+# @File    : C200_scheduler.py
+# 多芯片数据并行推理: 每个芯片写入相同的权重, 一个 batch 的图片按连续的块分给各芯片,
+# 每个芯片处理完自己的整块图片后再切换到下一个芯片, 选片的等待时间每块只付一次
+# =============================== #
+import time
+import numpy as np
+from c200_sdk.sdk_array_newsystem import SDKArray
+
+
+class MultiChipScheduler():
+    def __init__(self, chips, backend = None):
+        # ================================= #
+        # 参数说明
+        # ================================= #
+        # chips:
+        #   使用的芯片编号
+        # backend:
+        #   传给 SDKArray 的后端, 例如 'emulator' 或 EmulatorAPI(chips = 4)
+        self.chips = list(chips)
+        if backend is not None:
+            SDKArray.connect(backend)
+        self.sdks = {chip: SDKArray(chip) for chip in self.chips}
+        self.stats = dict(switches = 0, images = {chip: 0 for chip in self.chips},
+                          time = {chip: 0. for chip in self.chips})
+
+    def _select(self, chip):
+        if SDKArray._id != chip:
+            self.stats['switches'] += 1
+        SDKArray.select(chip)
+        return self.sdks[chip]
+
+    # 在所有芯片上写入相同的权重
+    def set_weight(self, weight, addr, **kwargs):
+        for chip in self.chips:
+            self._select(chip).set_weight(weight, addr = addr, **kwargs)
+
+    # 把 num 张图片分成与芯片数相同的连续块, 返回 [(chip, start, stop), ...]
+    def shard(self, num):
+        bounds = np.linspace(0, num, len(self.chips) + 1).round().astype(int)
+        return [(chip, int(bounds[i]), int(bounds[i + 1])) for i, chip in enumerate(self.chips)
+                if bounds[i + 1] > bounds[i]]
+
+    def run(self, forward, imgs, batch = False):
+        # ================================= #
+        # 参数说明
+        # ================================= #
+        # forward:
+        #   batch = False 时为单张图片的前向函数 forward(sdk, img), 例如 C200_pipeline.sequential_forward 的返回值
+        #   batch = True 时为一块图片的前向函数 forward(sdk, imgs), 例如基于 conv2d_144k_batch 的网络
+        # imgs:
+        #   图片序列或 [N, ...] 数组
+        # ===== 返回 =====
+        # outputs:
+        #   每张图片的输出, 顺序与 imgs 相同; batch = True 时为各块输出按第 0 维拼接的结果
+        outputs = []
+        for chip, start, stop in self.shard(len(imgs)):
+            sdk = self._select(chip)
+            t = time.perf_counter()
+            block = imgs[start:stop]
+            # calculate 内部的 select 与当前芯片相同, 不会再切片
+            if batch:
+                outputs.append(forward(sdk, block))
+            else:
+                outputs.extend(forward(sdk, img) for img in block)
+            self.stats['time'][chip] += time.perf_counter() - t
+            self.stats['images'][chip] += stop - start
+        if batch:
+            return np.concatenate(outputs, axis = 0)
+        return outputs
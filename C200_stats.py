@@ -0,0 +1,127 @@
+# =============================== #
+# @File    : C200_stats.py
+# ADC 输出与脉冲统计: 在线累加每层 / 每列的 ADC 码值直方图、每次调用的脉冲数和 bitlen 分布,
+# 全部为固定大小的 np.bincount 累加器, 不保存原始输出, 可以在长时间的评测中一直开启
+#
+# 用法:
+#   from C200_stats import adc_stats
+#   adc_stats.enable()
+#   conv1_out = conv2d_144k(sdk, img, ..., name = 'conv1')
+#   ...
+#   adc_stats.print_table()
+#   high, low = adc_stats.saturation('conv1')
+# =============================== #
+import threading
+import numpy as np
+from C200_profile import profiler
+
+ADC_LEVELS = 16  # 4-bit ADC
+ADC_OFFSET = 8  # output_bitwise = ADC 码值 - 8
+MAX_COLS = 128
+MAX_BITLEN = 64
+PULSE_BINS = 33  # 每次调用的脉冲数按 log2 分桶, 第 k 桶为 [2^(k-1), 2^k)
+
+
+class ADCStats():
+    def __init__(self, max_cols = MAX_COLS, max_bitlen = MAX_BITLEN):
+        self.enabled = False
+        self.max_cols = max_cols
+        self.max_bitlen = max_bitlen
+        self.layers = {}
+        self._lock = threading.Lock()
+        self._col_offset = np.arange(max_cols)[None, :] * ADC_LEVELS
+
+    def enable(self):
+        self.enabled = True
+        # 需要按层统计, 即使不计时也让层函数记录当前层名
+        profiler.require_layers('adc_stats')
+
+    def disable(self):
+        self.enabled = False
+        profiler.release_layers('adc_stats')
+
+    def reset(self):
+        with self._lock:
+            self.layers = {}
+
+    def _layer(self, name):
+        layer = self.layers.get(name)
+        if layer is None:
+            layer = self.layers[name] = dict(
+                calls = 0,
+                pulses = 0,
+                col_hist = np.zeros([self.max_cols, ADC_LEVELS], dtype = np.int64),
+                pulse_hist = np.zeros(PULSE_BINS, dtype = np.int64),
+                bitlen_hist = np.zeros(self.max_bitlen + 1, dtype = np.int64))
+        return layer
+
+    def record(self, output_bitwise, bitlen_map, layer = None):
+        # ================================= #
+        # 参数说明
+        # ================================= #
+        # output_bitwise:
+        #   一次乘加的 ADC 输出 (码值 - 8), [pulses, cols]
+        # bitlen_map:
+        #   input_bitwise_expansion_fast 返回的每列脉冲数
+        # layer:
+        #   层名, 默认为 C200_profile 中当前层函数的 name
+        if layer is None:
+            layer = profiler.current_layer()
+        pulses, cols = output_bitwise.shape
+        codes = np.clip(output_bitwise.astype(np.int64) + ADC_OFFSET, 0, ADC_LEVELS - 1)
+        col_hist = np.bincount((codes + self._col_offset[:, :cols]).ravel(),
+                               minlength = cols * ADC_LEVELS).reshape(cols, ADC_LEVELS)
+        bitlen = np.minimum(np.asarray(bitlen_map, dtype = np.int64), self.max_bitlen)
+        bitlen_hist = np.bincount(bitlen, minlength = self.max_bitlen + 1)
+        with self._lock:
+            entry = self._layer(layer)
+            entry['calls'] += 1
+            entry['pulses'] += pulses
+            entry['col_hist'][:cols] += col_hist
+            entry['pulse_hist'][min(int(pulses).bit_length(), PULSE_BINS - 1)] += 1
+            entry['bitlen_hist'] += bitlen_hist
+
+    # 码值直方图, column 为 None 时为所有列之和
+    def histogram(self, layer, column = None):
+        col_hist = self.layers[layer]['col_hist']
+        if column is None:
+            return col_hist.sum(axis = 0)
+        return col_hist[column]
+
+    # 饱和比例: 返回 (|码值 - 8| 达到 threshold 的正 / 负方向比例), per_column 时为每列的数组
+    def saturation(self, layer, threshold = 6, per_column = False):
+        col_hist = self.layers[layer]['col_hist']
+        if not per_column:
+            col_hist = col_hist.sum(axis = 0, keepdims = True)
+        total = np.maximum(col_hist.sum(axis = 1), 1)
+        high = col_hist[:, ADC_OFFSET + threshold:].sum(axis = 1) / total
+        low = col_hist[:, :max(ADC_OFFSET - threshold + 1, 0)].sum(axis = 1) / total
+        if not per_column:
+            return float(high[0]), float(low[0])
+        return high, low
+
+    def mean_bitlen(self, layer):
+        bitlen_hist = self.layers[layer]['bitlen_hist']
+        return float((bitlen_hist * np.arange(bitlen_hist.size)).sum() / max(bitlen_hist.sum(), 1))
+
+    def table(self, threshold = 6):
+        rows = []
+        for name, entry in self.layers.items():
+            hist = entry['col_hist'].sum(axis = 0)
+            codes = np.arange(ADC_LEVELS) - ADC_OFFSET
+            high, low = self.saturation(name, threshold)
+            rows.append(dict(layer = name, calls = entry['calls'], pulses = entry['pulses'],
+                             mean_abs_code = float((hist * np.abs(codes)).sum() / max(hist.sum(), 1)),
+                             saturation_high = high, saturation_low = low,
+                             mean_bitlen = self.mean_bitlen(name)))
+        return rows
+
+    def print_table(self, threshold = 6):
+        print(f'{"layer":<12}{"calls":>8}{"pulses":>12}{"mean|adc|":>11}'
+              f'{f">=+{threshold}":>9}{f"<=-{threshold}":>9}{"bitlen":>8}')
+        for row in self.table(threshold):
+            print(f'{str(row["layer"]):<12}{row["calls"]:>8}{row["pulses"]:>12}{row["mean_abs_code"]:>11.3f}'
+                  f'{row["saturation_high"]:>9.2%}{row["saturation_low"]:>9.2%}{row["mean_bitlen"]:>8.2f}')
+
+
+adc_stats = ADCStats()
@@ -1,6 +1,10 @@
 # from sim_utils import *
 import time
 import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+from C200_profile import profiler, span, profiled, profiled_layer
+from C200_stats import adc_stats
+from C200_calib import calibrator
 
 
 def scale_to_ascii(value):
@@ -29,18 +33,19 @@ def plot_ascii_img(img, spacing = 0, boarder = True):
 # Functions related to 144K simulation
 # ======================================== #
 # data quant
+@profiled('quantization')
 def data_quantization_sym(data_float, half_level = 15, scale = None, isint = 0, clamp_std = None):
     # isint = 1 -> return quantized values as integer levels
     # isint = 0 -> return quantized values as float numbers with the same range as input
     if half_level <= 0:
         return data_float, 0
 
-    std = data_float.std()
     # if clamp_std != None and clamp_std != 0:
     #     data_float = torch.clamp(data_float, min = -clamp_std * std, max = clamp_std * std)
 
     if scale == None or scale == 0:
-        scale = abs(data_float).max()
+        # 与 abs(data_float).max() 相同, 但不分配 abs 的中间结果
+        scale = max(data_float.max(), -data_float.min())
     if scale == 0:
         return data_float, 0
 
@@ -53,6 +58,82 @@ def data_quantization_sym(data_float, half_level = 15, scale = None, isint = 0,
     return data_quantized, quant_scale
 
 
+# 带 batch 维度的 data quant
+@profiled('quantization')
+def data_quantization_sym_batch(data_float, half_level = 15, isint = 0, per_sample = True):
+    # data_float shape = [N, ...]
+    # per_sample = True  -> 每个样本分别计算 scale, 与对每个样本调用 data_quantization_sym 的结果相同
+    # per_sample = False -> 整个 batch 共用一个 scale
+    # 返回值 quant_scale shape = [N], 全 0 样本的 quant_scale 为 0
+    if half_level <= 0:
+        return data_float, np.zeros([data_float.shape[0]])
+    if not per_sample:
+        data_quantized, quant_scale = data_quantization_sym(data_float, half_level = half_level, isint = isint)
+        return data_quantized, np.full([data_float.shape[0]], quant_scale, dtype = np.float64)
+
+    flat = data_float.reshape(data_float.shape[0], -1)
+    scale = np.maximum(flat.max(axis = 1), -flat.min(axis = 1)).astype(np.float64)
+    zero = scale == 0
+    scale[zero] = 1
+    scale_b = scale.reshape((-1,) + (1,) * (len(data_float.shape) - 1))
+
+    data_quantized = (data_float / scale_b * half_level).round()
+    quant_scale = 1 / scale * half_level
+    if isint == 0:
+        data_quantized = data_quantized * scale_b / half_level
+        quant_scale = np.ones_like(scale)
+    quant_scale[zero] = 0
+
+    return data_quantized, quant_scale
+
+
+# 静态量化: 使用固定 scale 的 乘 -> round -> 截断, 不做归约
+def quantize_static(data, scale, half_level = 15, channel_axis = -1):
+    # scale: float, 或每个通道一个值的数组 (沿 channel_axis)
+    # 返回值为 [-half_level, half_level] 的整数量化等级 (浮点数)
+    factor = _static_factor(scale, half_level)
+    if len(factor.shape):
+        shape = [1] * len(data.shape)
+        shape[channel_axis] = -1
+        factor = factor.reshape(shape)
+    data_quantized = np.multiply(data, factor)
+    np.round(data_quantized, out = data_quantized)
+    np.clip(data_quantized, -half_level, half_level, out = data_quantized)
+    return data_quantized
+
+
+def _static_factor(scale, half_level):
+    scale = np.asarray(scale, dtype = np.float64)
+    # 校准时全为 0 的层 / 通道: 与 data_quantization_sym 一样不缩放
+    return half_level / np.where(scale == 0, 1, scale)
+
+
+# 当前层 (C200_profile 中层函数的 name) 的量化 scale:
+# 校准时记录统计量并返回 None (仍按数据动态量化), 静态模式返回校准的 scale, 否则返回 None
+def calibration_scale(data, kind, relu = False, channel_axis = None):
+    if calibrator.mode is None:
+        return None
+    layer = profiler.current_layer()
+    # 默认的层名是层函数名, 同一函数的不同层会共用统计量和 scale
+    if layer is None or not profiler.current_layer_named():
+        raise ValueError(f'校准 / 静态量化时每个层函数需要传入不同的 name, 当前层 {layer} 没有指定 name')
+    if calibrator.mode == 'calibrate':
+        calibrator.observe(layer, kind, data, relu = relu, channel_axis = channel_axis)
+        return None
+    return calibrator.scale(layer, kind)
+
+
+# 层函数中的输入 / 输出量化: 有校准的 scale 时为静态量化, 否则同 data_quantization_sym(_batch)
+def layer_quantization(data, half_level, kind, batch = False, per_sample = True, channel_axis = None):
+    # kind: 'input' 或 'output'; channel_axis: 按通道校准时输出通道所在的维度
+    scale = calibration_scale(data, kind, channel_axis = channel_axis)
+    if scale is not None and half_level > 0:
+        return quantize_static(data, scale, half_level, channel_axis = -1 if channel_axis is None else channel_axis)
+    if batch:
+        return data_quantization_sym_batch(data, half_level = half_level, isint = 1, per_sample = per_sample)[0]
+    return data_quantization_sym(data, half_level = half_level, isint = 1)[0]
+
+
 # 给 feature_map 加上 padding
 def feature_map_padding(feature_map, padding):
     # feature_map 维度： C, W, H
@@ -71,8 +152,249 @@ def output_to_feature_map(out_put, out_w, out_h):
     return feature_map
 
 
+# 乘加之后的融合后处理: relu -> 量化 (缩放, round, 截断) -> 最大池化 -> 重排为下一层的输入
+# 与 relu + data_quantization_sym + output_to_feature_map + pooling 的结果完全相同,
+# 但只做一次 scale 的归约, 中间结果只有一份拷贝 (pool_first 时为池化后的大小)
+@profiled('post_mvm')
+def post_mvm_fused(output, out_rows, out_cols, half_level,
+                   relu = True,
+                   pool = None,
+                   pool_first = True,
+                   scale = None,
+                   per_sample = True,
+                   out = None):
+    # ================================= #
+    # 参数说明
+    # ================================= #
+    # output:
+    #   重组后的乘加结果, [out_rows * out_cols, C] 或带 batch 维度的 [N, out_rows * out_cols, C], 不会被修改
+    # half_level:
+    #   输出量化等级
+    # pool:
+    #   None 时不池化; int 为最大池化的 kernel_size (stride 相同, 不能整除的行列被舍去);
+    #   dict 为 pooling2d 的关键字参数, 例如 dict(kernel_size = 3, stride = 2, padding = 1, mode = 'avg')
+    # pool_first:
+    #   先池化再量化, scale 由池化前的数据计算; 最大池化时 round 单调, 两种顺序的结果相同,
+    #   先池化只需量化 1 / pool^2 的数据; 平均池化时先池化得到平均值的量化结果, 否则为量化值的平均
+    # scale:
+    #   None 时与 data_quantization_sym 相同, 取 (relu 后) 绝对值的最大值;
+    #   给定时为静态 scale (float 或每个输出通道一个值), 做 乘 -> round -> 截断到 [-half_level, half_level]
+    # per_sample:
+    #   带 batch 维度且 scale 为 None 时, 每个样本分别计算 scale (同 data_quantization_sym_batch)
+    # out:
+    #   可选的输出数组, 大小与返回值相同
+    # ===== 返回 =====
+    #   [C, H, W] 或 [N, C, H, W], H / W 为池化后的大小
+    batch = len(output.shape) == 3
+    data = output if batch else output[None]
+    batch_size, _, channels = data.shape
+    # [N, H * W, C] -> [N, C, H, W] 的视图, 不拷贝
+    data = data.reshape(batch_size, out_rows, out_cols, channels).transpose(0, 3, 1, 2)
+
+    # 动态 scale: 只做一次归约, relu 时负数不影响最大值
+    static = scale is not None
+    if not static:
+        axis = (1, 2, 3) if per_sample else None
+        scale = data.max(axis = axis)
+        if not relu:
+            scale = np.maximum(scale, -data.min(axis = axis))
+        scale = np.maximum(np.broadcast_to(scale, [batch_size]).astype(np.float64), 0)
+        # scale 为 0 时数据 (relu 后) 全为 0, 与 data_quantization_sym 一样不缩放
+        scale[scale == 0] = 1
+    else:
+        factor = _static_factor(scale, half_level)
+        factor = factor.reshape(1, -1, 1, 1) if len(factor.shape) else factor
+
+    def quantize(x):
+        # x 为新分配的数组, 原地计算; 动态 scale 时运算顺序与 data_quantization_sym 相同
+        if relu:
+            np.maximum(x, 0, out = x)
+        if half_level <= 0:
+            return x
+        if static:
+            x *= factor
+        else:
+            x /= scale.reshape(-1, 1, 1, 1)
+            x *= half_level
+        np.round(x, out = x)
+        if static:
+            np.clip(x, -half_level, half_level, out = x)
+        return x
+
+    if pool is not None and not isinstance(pool, dict):
+        pool = dict(kernel_size = pool)
+    if pool and pool_first:
+        # relu 与最大池化可以交换, 与平均池化不能
+        if relu and pool.get('mode', 'max') == 'avg':
+            data = np.maximum(data, 0)
+        result = quantize(pooling2d(data, **pool).astype(np.float64, copy = False))
+    else:
+        # 拷贝时保持乘加结果的内存顺序 [N, H, W, C], 最后再重排
+        result = quantize(data.astype(np.float64, copy = True))
+        if pool:
+            result = pooling2d(result, **pool)
+
+    if out is not None:
+        np.copyto(out.reshape(result.shape), result)
+        return out
+    result = np.ascontiguousarray(result)
+    return result if batch else result[0]
+
+
+# 池化输出大小, 与 PyTorch 相同: ceil_mode 时最后一个窗口必须从输入或左侧 padding 内开始
+def pooling_output_size(size, kernel_size, stride, padding = 0, ceil_mode = False):
+    span = size + 2 * padding - kernel_size
+    if span < 0:
+        raise ValueError(f'池化窗口 {kernel_size} 大于输入 {size} + 2 * padding {padding}')
+    if not ceil_mode:
+        return span // stride + 1
+    output_size = -(-span // stride) + 1
+    if (output_size - 1) * stride >= size + padding:
+        output_size -= 1
+    return output_size
+
+
+def _pair(value):
+    if isinstance(value, (tuple, list)):
+        return tuple(value)
+    return (value, value)
+
+
+# 沿 axis 的一维池化: kernel_size 个步长为 stride 的切片视图逐个归约, 只循环 kernel_size 次
+def _pool_axis(x, axis, kernel_size, stride, output_size, reduce):
+    index = [slice(None)] * len(x.shape)
+    output = None
+    for i in range(kernel_size):
+        index[axis] = slice(i, i + (output_size - 1) * stride + 1, stride)
+        window = x[tuple(index)]
+        if output is None:
+            output = window.copy()
+        else:
+            reduce(output, window, out = output)
+    return output
+
+
+# 通用二维池化: 任意 kernel / stride / padding, max / avg, floor / ceil 输出大小, 带 batch 维度
+# 先沿行、再沿列做一维池化 (max 与求和都可分离), 每一步都是对整个 feature map 的切片视图的逐元素运算
+@profiled('pooling')
+def pooling2d(feature_map, kernel_size, stride = None, padding = 0, mode = 'max', ceil_mode = False,
+              count_include_pad = True):
+    # ================================= #
+    # 参数说明
+    # ================================= #
+    # feature_map:
+    #   [C, H, W] 或 [N, C, H, W], 只在最后两维上池化; 可以是非连续的视图
+    # kernel_size, stride, padding:
+    #   int 或 (rows, cols); stride 为 None 时等于 kernel_size
+    # mode:
+    #   'max' 或 'avg'
+    # ceil_mode:
+    #   输出大小向上取整, 不完整的最后一个窗口也参与池化
+    # count_include_pad:
+    #   avg 时 padding 的 0 是否计入平均的分母 (ceil_mode 多出的部分始终不计入)
+    # ===== 返回 =====
+    #   [..., H_out, W_out], max 时 dtype 与输入相同, avg 时为浮点数
+    if mode not in ('max', 'avg'):
+        raise ValueError(f'不支持的池化方式 {mode}')
+    kernel = _pair(kernel_size)
+    stride = _pair(stride or kernel_size)
+    padding = _pair(padding)
+    in_size = feature_map.shape[-2:]
+    out_size = [pooling_output_size(in_size[i], kernel[i], stride[i], padding[i], ceil_mode) for i in range(2)]
+    # 所有窗口覆盖的范围 (相对于 padding 前的输入): [-padding, (out - 1) * stride + kernel - padding)
+    stop = [(out_size[i] - 1) * stride[i] + kernel[i] - padding[i] for i in range(2)]
+
+    # 舍去不参与池化的行列 (视图), 需要时补 padding
+    x = feature_map[..., :max(stop[0], 0), :max(stop[1], 0)]
+    if mode == 'avg' and not np.issubdtype(x.dtype, np.floating):
+        x = x.astype(np.float64)
+    extra = [max(stop[i] - in_size[i], 0) for i in range(2)]
+    if padding != (0, 0) or extra != [0, 0]:
+        if mode == 'max':
+            # max 时补最小值, ceil_mode 的规则保证每个窗口至少包含一个输入元素
+            pad_value = -np.inf if np.issubdtype(x.dtype, np.floating) else np.iinfo(x.dtype).min
+        else:
+            pad_value = 0
+        x = np.pad(x, [(0, 0)] * (len(x.shape) - 2) + [(padding[0], extra[0]), (padding[1], extra[1])],
+                   mode = 'constant', constant_values = pad_value)
+
+    reduce = np.maximum if mode == 'max' else np.add
+    output = _pool_axis(x, -2, kernel[0], stride[0], out_size[0], reduce)
+    output = _pool_axis(output, -1, kernel[1], stride[1], out_size[1], reduce)
+    if mode == 'max':
+        return output
+
+    # 每个窗口的有效元素个数 = 行方向个数 x 列方向个数
+    counts = []
+    for i in range(2):
+        start = np.arange(out_size[i]) * stride[i] - padding[i]
+        low, high = (-padding[i], in_size[i] + padding[i]) if count_include_pad else (0, in_size[i])
+        counts.append(np.minimum(start + kernel[i], high) - np.maximum(start, low))
+    output /= counts[0][:, None] * counts[1][None, :]
+    return output
+
+
+# im2col: 将 feature_map 的所有滑窗一次性排列为忆阻器的输入
+@profiled('im2col')
+def im2col(feature_map, kernel_size, stride, padding):
+    # feature_map shape = [C_in, W_in, H_in] 或带 batch 维度的 [N, C_in, W_in, H_in]
+    # 返回值 shape = [C_in * kernel_size ** 2, W_out * H_out] 或 [N, C_in * kernel_size ** 2, W_out * H_out]
+    # 滑窗由 sliding_window_view 给出, 不逐窗口拷贝, 只在最后排列为二维时拷贝一次
+    batch = len(feature_map.shape) == 4
+    if not batch:
+        while (len(feature_map.shape) < 3):
+            feature_map = np.expand_dims(feature_map, axis = 0)
+        feature_map = feature_map[None]
+    if padding:
+        feature_map = np.pad(feature_map, ((0, 0), (0, 0), (padding, padding), (padding, padding)),
+                             mode = 'constant')
+    batch_size, in_channels = feature_map.shape[:2]
+    # windows shape = [N, C_in, W_out, H_out, kernel_size, kernel_size]
+    windows = sliding_window_view(feature_map, (kernel_size, kernel_size), axis = (2, 3))[:, :, ::stride, ::stride]
+    feature_out_w, feature_out_h = windows.shape[2:4]
+    array_input = windows.transpose(0, 1, 4, 5, 2, 3).reshape(
+        batch_size, in_channels * kernel_size ** 2, feature_out_w * feature_out_h)
+    if not batch:
+        array_input = array_input[0]
+    return array_input
+
+
+# 是否为 feature_map_to_input(..., lazy = True) 返回的行复制视图:
+# 行复制由 np.broadcast_to 给出, 复制维度的 stride 为 0 (只有一份时两种解释的结果相同)
+def is_row_repeat_view(input, axis = 0):
+    return input.shape[axis] == 1 or input.strides[axis] == 0
+
+
+def check_row_repeat_view(input, func_name, axis = 0, batch_func = None):
+    if is_row_repeat_view(input, axis):
+        return
+    message = (f'{func_name}: {len(input.shape)} 维输入只能是 feature_map_to_input(..., lazy = True) '
+               f'返回的行复制视图 (第 {axis} 维 stride 为 0)')
+    if batch_func is not None:
+        message += f', 带 batch 维度的输入 [N, rows, cal_times] 请使用 {batch_func}'
+    raise ValueError(message)
+
+
 # 将 feature_map 转化为下一层忆阻器的输入 array_input
-def feature_map_to_input(feature_map, kernel_size, stride, padding, repeat = None):
+@profiled('im2col')
+def feature_map_to_input(feature_map, kernel_size, stride, padding, repeat = None, lazy = False):
+    # feature_map shape = [C_in, W_in, H_in] 或 [N, C_in, W_in, H_in]
+    # array_input shape = [C_in * kernel_size ** 2 * repeat[0], W_out * H_out], 带 batch 维度时前面多一维 N
+    # lazy:
+    #   为 True 时行复制不实际拷贝, 返回 shape 为 [repeat[0], C_in * kernel_size ** 2, W_out * H_out]
+    #   (带 batch 时为 [N, repeat[0], ...]) 的广播视图, 其 reshape 为二维后与复制后的 array_input 相同;
+    #   mvm_bitwise_concat_push_fast / mvm_bitwise_concat_push_fast_144k 可以直接接收该视图
+    array_input = im2col(feature_map, kernel_size, stride, padding)
+    if repeat:
+        array_input = np.broadcast_to(array_input[..., None, :, :],
+                                      array_input.shape[:-2] + (repeat[0],) + array_input.shape[-2:])
+        if not lazy:
+            array_input = array_input.reshape(array_input.shape[:-3] + (-1, array_input.shape[-1]))
+    return array_input
+
+
+# feature_map_to_input 的逐窗口实现, 保留作为参考实现
+def feature_map_to_input_loop(feature_map, kernel_size, stride, padding, repeat = None):
     # feature_map shape = [C_in, W_in, H_in]
     # array_input shape = [W_out * H_out, C_out]
     while (len(feature_map.shape) < 3):
@@ -109,6 +431,16 @@ def weight_avg(weight, repeat):
     # weight 是从忆阻器中读出的多个重复的矩阵
     # repeat 是这个矩阵重复的次数, 格式为 [row_repeat, col_repeat]
     # 实际权重值的大小为 [weight.shape[0] / row_repeat, weight.shape[1] / col_repeat]
+    # 各复制块按与 weight_avg_loop 相同的顺序累加, 结果完全一致
+    m, n = weight.shape[0] // repeat[0], weight.shape[1] // repeat[1]
+    blocks = weight[:repeat[0] * m, :repeat[1] * n].reshape(repeat[0], m, repeat[1], n)
+    weight_avg = blocks.transpose(0, 2, 1, 3).reshape(-1, m, n).sum(axis = 0, dtype = np.float64)
+    weight_avg /= (repeat[0] * repeat[1])
+    return weight_avg
+
+
+# weight_avg 的逐块实现, 作为参考
+def weight_avg_loop(weight, repeat):
     weight_avg = np.zeros([weight.shape[0] // repeat[0], weight.shape[1] // repeat[1]])
     m, n = weight_avg.shape
     for row in range(repeat[0]):
@@ -127,6 +459,7 @@ def softmax(cross_bar_final_output):
     return prob
 
 
+@profiled('expansion')
 def input_bitwise_expansion_fast(input, dense = True, assign_pulses = None):
     # input 是一个按照 144k 输入数据格式重新排列好的数, 该函数将其每列进行 bitwise 展开
     # input size = [rows, cols]
@@ -138,6 +471,61 @@ def input_bitwise_expansion_fast(input, dense = True, assign_pulses = None):
     # 即展开后都是 0 的列直接丢弃
     # 在计算时需要知道 bitlen_map 中每个 col 展开了多少次, 根据该值对 144k 的计算结果进行求和处理
     # assign_pulses -> 指定bitwise展开的脉冲次数，如果不是None，则自动判定dense = Fasle
+    #
+    # 闭式展开: 第 k 个脉冲的值为 sign(x) * (k < abs(x)), 不再逐脉冲地对 input 减 1,
+    # 展开结果为 int8, 与 input_bitwise_expansion_loop 的结果逐元素相同
+
+    # 如果输入为全 0 矩阵, 直接返回其本身, 在后续的 mvm 中跳过这次计算
+    if (input == 0).all():
+        return input, []
+
+    if len(input.shape) == 1:
+        input = input.reshape(-1, 1)
+    input = input.astype(np.int32)
+    rows, cols = input.shape
+
+    input_abs = abs(input)
+    input_sign = np.sign(input).astype(np.int8)
+
+    # 指定了每列的展开长度, 超出部分截断, 不足部分补 0
+    if assign_pulses:
+        pulse_index = np.arange(assign_pulses)
+        input_expanded = (pulse_index < input_abs[:, :, None]) * input_sign[:, :, None]
+        input_expanded = input_expanded.reshape(rows, -1)
+        bitlen_map = (np.ones([cols]) * assign_pulses).astype(np.int32)
+
+    # 按照每列的最大值展开, 直接生成稠密矩阵, 全 0 的脉冲列不会被生成
+    elif dense == True:
+        bitlen_map = input_abs.max(axis = 0).astype(np.int64)
+        # pulse_col[p] 为第 p 个脉冲所属的 input 列, pulse_index[p] 为其在该列中的脉冲序号
+        pulse_col = np.repeat(np.arange(cols), bitlen_map)
+        pulse_offset = np.cumsum(bitlen_map) - bitlen_map
+        pulse_index = np.arange(pulse_col.size) - np.repeat(pulse_offset, bitlen_map)
+        input_expanded = (pulse_index < input_abs[:, pulse_col]) * input_sign[:, pulse_col]
+
+    # 按照 input 中的最大值作为所有列的展开位数
+    else:
+        max_range = int(input_abs.max())
+        pulse_index = np.arange(max_range)
+        input_expanded = (pulse_index < input_abs[:, :, None]) * input_sign[:, :, None]
+        input_expanded = input_expanded.reshape(rows, -1)
+        bitlen_map = (np.ones([cols]) * max_range).astype(np.int32)
+
+    return input_expanded.astype(np.int8, copy = False), bitlen_map
+
+
+# 逐脉冲展开的实现, 保留作为 input_bitwise_expansion_fast 的参考实现
+def input_bitwise_expansion_loop(input, dense = True, assign_pulses = None):
+    # input 是一个按照 144k 输入数据格式重新排列好的数, 该函数将其每列进行 bitwise 展开
+    # input size = [rows, cols]
+    # 如果 dense != True:
+    #   返回值是一个展开后的稀疏二维数组, 按照 input 中的最大值作为 bitwise 展开的位数, 对每列进行展开
+    # output size = [rows, cols * bitlen]
+    # 如果 dense == True:
+    #   返回值是一个稠密二维数组, 分别按照 input 中每列的最大值作为 bitwise 的展开位数。
+    # 即展开后都是 0 的列直接丢弃
+    # 在计算时需要知道 bitlen_map 中每个 col 展开了多少次, 根据该值对 144k 的计算结果进行求和处理
+    # assign_pulses -> 指定bitwise展开的脉冲次数，如果不是None，则自动判定dense = Fasle
 
     # 如果输入为全 0 矩阵, 直接返回其本身, 在后续的 mvm 中跳过这次计算
     if (input == 0).all():
@@ -199,10 +587,63 @@ def input_bitwise_expansion_fast(input, dense = True, assign_pulses = None):
     return input_expanded, bitlen_map
 
 
+# 按照 bitlen_map 对展开后的计算结果分段求和
+@profiled('regroup')
+def bitwise_segment_sum(output_bitwise, bitlen_map, out = None):
+    # output_bitwise size = [sum(bitlen_map), output_cols], 每个脉冲一行
+    # 返回值 size = [len(bitlen_map), output_cols], 第 i 行为第 i 段 (bitlen_map[i] 行) 的和, 长度为 0 的段结果为 0
+    # out 不为 None 时结果直接写入 out
+    bitlen_map = np.asarray(bitlen_map, dtype = np.int64)
+    if out is None:
+        out = np.zeros([bitlen_map.size, output_bitwise.shape[1]])
+    else:
+        out[:] = 0
+    nonzero = bitlen_map > 0
+    if not nonzero.any():
+        return out
+    # reduceat 对长度为 0 的段会返回该位置的元素而不是 0, 因此只对非空段的起始位置求和,
+    # 非空段之间夹着的空段不占行, 相邻两个非空段起始位置之差恰好等于前一段的长度
+    seg_start = np.cumsum(bitlen_map) - bitlen_map
+    # 在 out 的数据类型中累加, 避免 int8 的 ADC 输出在求和时溢出
+    out[nonzero] = np.add.reduceat(output_bitwise[:bitlen_map.sum()], seg_start[nonzero], axis = 0,
+                                   dtype = out.dtype)
+    return out
+
+
+# bitwise_segment_sum 的逐段实现, 保留作为参考实现
+def bitwise_segment_sum_loop(output_bitwise, bitlen_map, out = None):
+    if out is None:
+        out = np.zeros([len(bitlen_map), output_bitwise.shape[1]])
+    output_bitwise_row = 0
+    output_row = 0
+    for j in bitlen_map:
+        if j == 0:
+            out[output_row] = 0
+        else:
+            out[output_row] = output_bitwise[output_bitwise_row:output_bitwise_row + j].sum(axis = 0)
+        output_row += 1
+        output_bitwise_row += j
+    return out
+
+
+# 权重复制时, 对 output 中重复的列求平均, 并除以行复制次数
+@profiled('repeat_avg')
+def repeat_avg(output, repeat):
+    row_repeat = repeat[0]
+    col_repeat = repeat[1]
+    output_avg_cols = int(output.shape[1] / col_repeat)
+    output_avg = np.zeros([output.shape[0], output_avg_cols])
+    for i in range(col_repeat):
+        output_avg += output[:, i * output_avg_cols: (i + 1) * output_avg_cols]
+    output_avg /= col_repeat
+    output_avg /= row_repeat
+    return output_avg
+
+
 # bitwise 乘加运算
 def mvm_bitwise_concat_push_fast_144k(sdk, input, addr, repeat = None, it_time = 5, verbose = 0):
     # cal_times 是该层运算的总次数，如卷积滑窗的次数，如果是全连接则 cal_times = 1
-    cal_times = input.shape[1]
+    cal_times = input.shape[-1]
     # 输出通道数
     output_cols = addr[3]
     # 创建一个全零的输出矩阵
@@ -212,21 +653,24 @@ def mvm_bitwise_concat_push_fast_144k(sdk, input, addr, repeat = None, it_time =
     #   input_expanded 是一个只有 +1,0，-1的矩阵
     #   bitlen_map 中记录了 input 中每一列展开的最大 bit 位数,
     #   在 144k 计算完毕后会根据 bitlen_map 中记录的 bit 位数做对应行的累加
-    input_expanded, bitlen_map = input_bitwise_expansion_fast(input)
-    output_bitwise = np.array(
-        sdk.calculate(input_expanded.transpose(1, 0), addr = addr, it_time = it_time)).astype(np.int8) - 8
-
-    output_bitwise_row = 0
-    output_row = 0
+    # 输入为 feature_map_to_input(..., lazy = True) 返回的行复制视图 [repeat[0], rows, cal_times] 时,
+    # 复制后每列的最大值不变, 只需展开一份再按行复制
+    if len(input.shape) == 3:
+        check_row_repeat_view(input, 'mvm_bitwise_concat_push_fast_144k',
+                              batch_func = 'mvm_bitwise_concat_push_fast_144k_batch')
+        row_repeat = input.shape[0]
+        input_expanded, bitlen_map = input_bitwise_expansion_fast(input[0])
+        input_expanded = np.tile(input_expanded, [row_repeat, 1])
+    else:
+        input_expanded, bitlen_map = input_bitwise_expansion_fast(input)
+    with span('mvm_chip'):
+        output_bitwise = np.array(
+            sdk.calculate(input_expanded.transpose(1, 0), addr = addr, it_time = it_time)).astype(np.int8) - 8
+    if adc_stats.enabled:
+        adc_stats.record(output_bitwise, bitlen_map)
 
     # 对计算结果按照展开的位数进行求和
-    for j in bitlen_map:
-        if j == 0:
-            output[output_row, :] = 0
-        else:
-            output[output_row, :] = output_bitwise[output_bitwise_row:output_bitwise_row + j].sum(axis = 0)
-        output_row += 1
-        output_bitwise_row += j
+    bitwise_segment_sum(output_bitwise, bitlen_map, out = output)
 
     # ==================================================== #
     # for debug
@@ -244,38 +688,85 @@ def mvm_bitwise_concat_push_fast_144k(sdk, input, addr, repeat = None, it_time =
 
     # 如果权重复制了, 求出 output 的平均值
     if repeat:
-        row_repeat = repeat[0]
-        col_repeat = repeat[1]
-        output_avg_cols = int(output_cols / col_repeat)
-        output_avg = np.zeros([cal_times, output_avg_cols])
-        for i in range(col_repeat):
-            output_avg += output[:, i * output_avg_cols: (i + 1) * output_avg_cols]
-        output_avg /= col_repeat
-        output_avg /= row_repeat
-        return output_avg
+        return repeat_avg(output, repeat)
     return output
 
 
+# 单次 sdk.calculate 最多送入的脉冲数 (展开后的输入行数)
+MAX_PULSES_PER_CALL = 8192
+
+
+# 多张图片的 bitwise 乘加运算, 所有图片展开后的脉冲合并到尽量少的 sdk.calculate 调用中
+def mvm_bitwise_concat_push_fast_144k_batch(sdk, input, addr, repeat = None, it_time = 5,
+                                            max_pulses = MAX_PULSES_PER_CALL):
+    # input shape = [N, rows, cal_times],
+    #   或 feature_map_to_input(..., lazy = True) 返回的 [N, repeat[0], rows, cal_times]
+    # 返回值 shape = [N, cal_times, output_cols], 与逐张调用 mvm_bitwise_concat_push_fast_144k 的结果相同
+    # max_pulses:
+    #   单次 sdk.calculate 的最大脉冲数, 超出时分多次调用, 一列的脉冲可以被分到相邻两次调用中
+    batch_size = input.shape[0]
+    cal_times = input.shape[-1]
+    output_cols = addr[3]
+
+    if len(input.shape) == 4:
+        check_row_repeat_view(input, 'mvm_bitwise_concat_push_fast_144k_batch', axis = 1)
+        row_repeat = input.shape[1]
+        input = input[:, 0]
+    else:
+        row_repeat = 1
+    rows = input.shape[1]
+
+    # bitwise 展开对每列独立, 所有图片的列拼接后一次展开
+    input_concat = input.transpose(1, 0, 2).reshape(rows, batch_size * cal_times)
+    input_expanded, bitlen_map = input_bitwise_expansion_fast(input_concat)
+    output = np.zeros([batch_size * cal_times, output_cols])
+
+    # 全 0 输入的结果全部为 0, 不需要上片计算
+    if len(bitlen_map) > 0:
+        if row_repeat > 1:
+            input_expanded = np.tile(input_expanded, [row_repeat, 1])
+        input_pulses = input_expanded.transpose(1, 0)
+        pulse_num = input_pulses.shape[0]
+        output_bitwise = np.empty([pulse_num, output_cols], dtype = np.int8)
+        with span('mvm_chip'):
+            for start in range(0, pulse_num, max_pulses):
+                stop = min(start + max_pulses, pulse_num)
+                output_bitwise[start:stop] = np.array(
+                    sdk.calculate(input_pulses[start:stop], addr = addr, it_time = it_time)).astype(np.int8) - 8
+        if adc_stats.enabled:
+            adc_stats.record(output_bitwise, bitlen_map)
+        bitwise_segment_sum(output_bitwise, bitlen_map, out = output)
+
+    if repeat:
+        output = repeat_avg(output, repeat)
+    return output.reshape(batch_size, cal_times, -1)
+
+
 # CPU MVM仿真器
-def mvm_bitwise_concat_push_fast(input, weight, repeat = None, verbose = 0):
+def mvm_bitwise_concat_push_fast(input, weight, repeat = None, verbose = 0, ideal = False):
     # bitwise乘加运算
+    # verbose:
+    #   保留参数, 各步骤的耗时请使用 C200_profile 统计
+    # ideal:
+    #   理想 ADC 下, 展开后的 +-1 脉冲与权重相乘再按 bitlen_map 求和, 结果恰好等于 input.T @ weight,
+    #   此时跳过 bitwise 展开和求和, 直接计算矩阵乘; 需要对 ADC 截断/噪声建模时应使用展开路径
+    # 输入为 feature_map_to_input(..., lazy = True) 返回的行复制视图 [repeat[0], rows, cal_times] 时,
+    # 复制的输入与整个权重相乘, 等于原输入与各复制权重块之和相乘, 只需计算一份
+    if len(input.shape) == 3:
+        check_row_repeat_view(input, 'mvm_bitwise_concat_push_fast', batch_func = 'mvm_bitwise_concat_push_fast_batch')
+        weight = weight.reshape(input.shape[0], input.shape[1], -1).sum(axis = 0)
+        input = input[0]
     cal_times = input.shape[1]
     output_cols = weight.shape[1]
+    if ideal:
+        output = mvm_gemm(input, weight).astype(np.float64, copy = False)
+        if repeat:
+            return repeat_avg(output, repeat)
+        return output
     output = np.zeros([cal_times, output_cols])
 
-    # ========== DEBUG ========= #
-    time_s = time.time()
-    # ========================== #
-
     input_expanded, bitlen_map = input_bitwise_expansion_fast(input)
 
-    # ========== DEBUG ========= #
-    time_e = time.time()
-    time_elapsed = time_e - time_s
-    if verbose:
-        print(f'bitwise expansion time = {time_elapsed}')
-    # ========================== #
-
     # 如果feature map展开后的返回值为全0矩阵(即feature map)为全0, 直接跳过这次运算, 返回一个尺寸正确的全0矩阵作为结果
     if (input_expanded == 0).all():
         if repeat:
@@ -285,53 +776,48 @@ def mvm_bitwise_concat_push_fast(input, weight, repeat = None, verbose = 0):
             return output
     output_bitwise = sdk_cal_sim(input_expanded, weight)
 
-    output_bitwise_col = 0
-    output_row = 0
-
-    # ========== DEBUG ========= #
-    time_s = time.time()
-    # ========================== #
-
     # 对计算结果按照展开的位数进行求和
-    for j in bitlen_map:
-        if j == 0:
-            output[output_row] = 0
-        else:
-            output[output_row] = output_bitwise[output_bitwise_col:output_bitwise_col + j].sum(axis = 0)
-        output_row += 1
-        output_bitwise_col += j
+    bitwise_segment_sum(output_bitwise, bitlen_map, out = output)
 
     # 如果权重复制了, 求出output的平均值
     if repeat:
-        row_repeat = repeat[0]
-        col_repeat = repeat[1]
-        cols_output_avg = int(output_cols / col_repeat)
-        output_avg = np.zeros([cal_times, cols_output_avg])
-        for i in range(col_repeat):
-            output_avg += output[:, i * cols_output_avg: (i + 1) * cols_output_avg]
-        output_avg /= col_repeat
-        output_avg /= row_repeat
-
-        # ========== DEBUG ========= #
-        time_e = time.time()
-        time_elapsed = time_e - time_s
-        if verbose:
-            print(f'bitwise expansion time = {time_elapsed}')
-        # ========================== #
-
-        return output_avg
-
-    # ========== DEBUG ========= #
-    time_e = time.time()
-    time_elapsed = time_e - time_s
-    if verbose:
-        print(f'bitwise expansion time = {time_elapsed}')
-    # ========================== #
+        return repeat_avg(output, repeat)
     return output
 
 
+# 多张图片的 CPU MVM 仿真, 所有图片的列拼接后一次完成展开、乘加和求和
+def mvm_bitwise_concat_push_fast_batch(input, weight, repeat = None, ideal = False):
+    # input shape = [N, rows, cal_times],
+    #   或 feature_map_to_input(..., lazy = True) 返回的 [N, repeat[0], rows, cal_times]
+    # 返回值 shape = [N, cal_times, output_cols], 与逐张调用 mvm_bitwise_concat_push_fast 的结果相同
+    batch_size = input.shape[0]
+    cal_times = input.shape[-1]
+    if len(input.shape) == 4:
+        check_row_repeat_view(input, 'mvm_bitwise_concat_push_fast_batch', axis = 1)
+        row_repeat = input.shape[1]
+        input = input[:, 0]
+    else:
+        row_repeat = None
+    rows = input.shape[1]
+    input_concat = input.transpose(1, 0, 2).reshape(rows, batch_size * cal_times)
+    if row_repeat:
+        input_concat = np.broadcast_to(input_concat, (row_repeat,) + input_concat.shape)
+    output = mvm_bitwise_concat_push_fast(input_concat, weight, repeat, ideal = ideal)
+    return output.reshape(batch_size, cal_times, -1)
+
+
 # simulate the mvm process in C200 SDK
-def sdk_cal_sim(input, weight, it_time = 1):
+def sdk_cal_sim(input, weight, it_time = 1, acc_dtype = None, chunk_size = None):
+    # input size = [rows, cal_times], weight size = [rows, output_cols]
+    # output size = [cal_times, output_cols]
+    # 默认使用 gemm 引擎, 一次矩阵乘完成所有列的计算; acc_dtype / chunk_size 见 mvm_gemm
+    result = mvm_gemm(input, weight, acc_dtype = acc_dtype, chunk_size = chunk_size)
+    result *= it_time
+    return result
+
+
+# sdk_cal_sim 的逐列实现, 保留作为 gemm 引擎的参考实现
+def sdk_cal_sim_loop(input, weight, it_time = 1):
     cal_times = input.shape[1]
     sum = []
     for i in range(cal_times):
@@ -341,6 +827,39 @@ def sdk_cal_sim(input, weight, it_time = 1):
     result *= it_time
     return result
 
+
+# 批量矩阵乘引擎: result = input.T @ weight
+@profiled('mvm_sim')
+def mvm_gemm(input, weight, acc_dtype = None, chunk_size = None):
+    # input size = [rows, cal_times], weight size = [rows, output_cols]
+    # acc_dtype:
+    #   None -> 结果类型与逐列实现一致 (numpy 类型提升);
+    #           整数运算在 float64 中经 BLAS 完成, 累加和小于 2**53 时与整数运算结果完全一致
+    #   np.int8 / np.int16 / ... -> 输入与权重转换为该类型后直接累加, 由调用者保证不溢出
+    # chunk_size:
+    #   每次矩阵乘处理的 input 列数, 用于限制展开后大输入的临时内存; None 表示一次算完
+    if acc_dtype is None:
+        out_dtype = np.result_type(input, weight)
+        if np.issubdtype(out_dtype, np.integer) or out_dtype == np.bool_:
+            calc_dtype = np.float64
+        else:
+            calc_dtype = out_dtype
+    else:
+        out_dtype = np.dtype(acc_dtype)
+        calc_dtype = out_dtype
+    weight = np.asarray(weight, dtype = calc_dtype)
+
+    cal_times = input.shape[1]
+    if chunk_size is None or chunk_size >= cal_times:
+        result = np.asarray(input, dtype = calc_dtype).T @ weight
+        return result.astype(out_dtype, copy = False)
+
+    result = np.empty([cal_times, weight.shape[1]], dtype = out_dtype)
+    for start in range(0, cal_times, chunk_size):
+        stop = min(start + chunk_size, cal_times)
+        result[start:stop] = np.asarray(input[:, start:stop], dtype = calc_dtype).T @ weight
+    return result
+
 # =========================================================== #
 # Discarded Functions
 # =========================================================== #
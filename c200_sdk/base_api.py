@@ -1,12 +1,21 @@
+import atexit
 import ctypes
 import os
 import time
 
 import numpy as np
-from pynq import MMIO
-from pynq.lib.iic import AxiIIC
 from pathlib import Path
+from contextlib import contextmanager
 import signal
+import threading
+
+try:
+    from pynq import MMIO
+    from pynq.lib.iic import AxiIIC
+except ImportError:
+    # 不在板上时没有 pynq, 只能使用 FakeMMIO
+    MMIO = None
+    AxiIIC = None
 
 BASE_ADDR = 0xA0000000
 ADDRESS_RANGE = 0x4000
@@ -57,6 +66,14 @@ WRITE_WEIGHT_RESET_MAX_TIMES    = 0x1090
 MAX_CLKNUM_WRITE_WEIGHT         = 0x1094
 VERIFY_WEIGHT_MAX_TIMES         = 0x1098
 
+# 状态寄存器、触发寄存器和计数器, 写入不能被合并或丢弃, 也不缓存其值
+VOLATILE_REGS = frozenset([REG0_ADDR, REG1_ADDR, REG2_ADDR, REG3_ADDR,
+                           WRITE_WEIGHT_TOTAL_NUM, WRITE_WEIGHT_RIGHT_NUM,
+                           WRITE_WEIGHT_NOSET_NUM, WRITE_WEIGHT_OVERTIME_NUM])
+
+# 计算输出缓冲池最多保留的 (shape, dtype) 种类
+OUT_POOL_SIZE = 8
+
 TOTAL_ROW = 1152
 TOTAL_CHANNEL = 8
 ONE_CHANNEL_ROW = 144
@@ -84,6 +101,57 @@ par_dir = Path(FILE_PATH).parent
 
 
 CLIB_PATH = f'/root/Helium-100_Demo/sunqiao/c200_sdk/libBaseApi.so'  # f'{par_dir}/c200_sdk/libBaseApi.so'
+# 设置该环境变量可覆盖 CLIB_PATH
+CLIB_ENV = 'C200_CLIB_PATH'
+
+# libBaseApi.so 的函数原型: name -> (restype, argtypes)
+# 声明后 ctypes 不再逐次推断参数类型
+CLIB_PROTOTYPES = {
+    'ElememDev_Init': (ctypes.c_int, []),
+    'OpenMMIO': (ctypes.c_int, []),
+    'CloseMMIO': (ctypes.c_int, []),
+    # (rowInput, rowStart, rowCount, colStart, colCount, output, calcCount, data_type, split_mode, time_out_ms)
+    'ElememDev_CalcArray': (ctypes.c_int, [ctypes.c_void_p, ctypes.c_int, ctypes.c_int, ctypes.c_int, ctypes.c_int,
+                                           ctypes.c_void_p, ctypes.c_int, ctypes.c_int, ctypes.c_int, ctypes.c_int]),
+    # (rowStart, colStart, rowCount, colCount, data_is_zero, weightInput, time_out_s)
+    'ElememDev_WriteWeight': (ctypes.c_int, [ctypes.c_int, ctypes.c_int, ctypes.c_int, ctypes.c_int, ctypes.c_int,
+                                             ctypes.c_void_p, ctypes.c_int]),
+    # (rowStart, colStart, rowCount, colCount, output, type_is_2t2r, time_out_ms)
+    'ElememDev_ReadWeight': (ctypes.c_int, [ctypes.c_int, ctypes.c_int, ctypes.c_int, ctypes.c_int,
+                                            ctypes.c_void_p, ctypes.c_int, ctypes.c_int]),
+    # (mode)
+    'ElememDev_SwitchMode': (ctypes.c_int, [ctypes.c_int]),
+    # (rowInput, rowStart, rowCount, colStart, colCount, output, calcCount)
+    'CalcArray_2': (ctypes.c_int, [ctypes.c_void_p, ctypes.c_int, ctypes.c_int, ctypes.c_int, ctypes.c_int,
+                                   ctypes.c_void_p, ctypes.c_int]),
+}
+
+_clib = None
+
+
+def declare_prototypes(clib):
+    for name, (restype, argtypes) in CLIB_PROTOTYPES.items():
+        func = getattr(clib, name)
+        func.restype = restype
+        func.argtypes = argtypes
+    return clib
+
+
+def get_clib():
+    """Load libBaseApi.so once per process and return the shared handle.
+
+    The library is initialised (ElememDev_Init, OpenMMIO) on first use and
+    CloseMMIO is registered to run at exit.
+    """
+    global _clib
+    if _clib is None:
+        clib = declare_prototypes(ctypes.cdll.LoadLibrary(os.environ.get(CLIB_ENV, CLIB_PATH)))
+        clib.ElememDev_Init()
+        clib.OpenMMIO()
+        atexit.register(clib.CloseMMIO)
+        _clib = clib
+    return _clib
+
 
 def mySleep(delayTime):
     startTime = time.perf_counter()
@@ -107,52 +175,109 @@ def currentToReg(valmA):
     return val
 
 
-class DIN():
-    def __init__(self, regAddr = 0, selectedBitMap = 0, actualBitMap = 0):
-        self.cfgPara(regAddr, selectedBitMap, actualBitMap)
+class FakeMMIO():
+    """A register file in memory with the pynq.MMIO read/write interface.
 
-    def cfgPara(self, regAddr, selectedBitMap, actualBitMap = 0):
-        self.regAddr = regAddr
-        self.selectedBitMap = selectedBitMap
-        self.actualBitMap = actualBitMap
+    Used to count register accesses of BaseAPI without hardware.
+    """
+
+    def __init__(self, base_addr = BASE_ADDR, length = ADDRESS_RANGE):
+        self.base_addr = base_addr
+        self.length = length
+        self.regs = {}
+        self.write_count = 0
+        self.read_count = 0
+        self.write_log = []
+
+    def write(self, addr, value):
+        self.regs[addr] = value
+        self.write_count += 1
+        self.write_log.append((addr, value))
+        # 模拟 opFlow 的握手: REG1 置 1 时操作完成, 置位 REG0 中的完成标志, 写 REG3 清除操作时复位该标志
+        if addr == REG1_ADDR and value == 1:
+            op = self.regs.get(REG3_ADDR, 0)
+            bitPosition = 8 if op in (0xf, 0x1f) else op
+            self.regs[REG0_ADDR] = self.regs.get(REG0_ADDR, 0) | (1 << bitPosition)
+        elif addr == REG3_ADDR and (value == 0xFF or value & 0x10):
+            bitPosition = 8 if value == 0xFF else value & 0xF
+            self.regs[REG0_ADDR] = self.regs.get(REG0_ADDR, 0) & ~(1 << bitPosition)
+
+    def read(self, addr):
+        self.read_count += 1
+        return self.regs.get(addr, 0)
 
 
 class BaseAPI():
     version = "v2.0"
 
-    def __init__(self):
-        self.mmio = MMIO(BASE_ADDR, ADDRESS_RANGE)
-        self.DIN0 = [DIN() for _ in range(ONE_CHANNEL_ROW)]
-        self.DIN1 = [DIN() for _ in range(ONE_CHANNEL_ROW)]
-        self.DIN2 = [DIN() for _ in range(ONE_CHANNEL_ROW)]
-        self.DIN3 = [DIN() for _ in range(ONE_CHANNEL_ROW)]
-        self.DIN4 = [DIN() for _ in range(ONE_CHANNEL_ROW)]
-        self.DIN5 = [DIN() for _ in range(ONE_CHANNEL_ROW)]
-        self.DIN6 = [DIN() for _ in range(ONE_CHANNEL_ROW)]
-        self.DIN7 = [DIN() for _ in range(ONE_CHANNEL_ROW)]
+    def __init__(self, mmio = None, clib = None):
+        """
+        Args:
+            mmio: object with write(addr, value) / read(addr), e.g. FakeMMIO
+                    Defaults to pynq.MMIO(BASE_ADDR, ADDRESS_RANGE).
+            clib: ctypes library handle
+                    Defaults to the process-wide handle from get_clib().
+        """
+        self.mmio = mmio if mmio is not None else MMIO(BASE_ADDR, ADDRESS_RANGE)
+        # 影子寄存器: 记录最近写入的值, 写入相同的值时直接跳过
+        self.shadow_enabled = True
+        self.volatile_regs = set(VOLATILE_REGS)
+        self._shadow = {}
+        self._pending_writes = None
+        self.reg_stats = dict(writes = 0, skipped = 0, reads = 0)
+        # 计算输出缓冲池, 按 (shape, dtype) 复用
+        self._out_pool = {}
         self.cfgDIN()
-        self.DINArr = (self.DIN0, self.DIN1, self.DIN2, self.DIN3, self.DIN4,
-                       self.DIN5, self.DIN6, self.DIN7)
         self.dictIic3 = {'phys_addr': 0xA0004000, 'addr_range': 0x1000}
         self.dictIic4 = {'phys_addr': 0xA0005000, 'addr_range': 0x1000}
         self.dictIic5 = {'phys_addr': 0xA0006000, 'addr_range': 0x1000}
-        self.clib = ctypes.cdll.LoadLibrary(CLIB_PATH)
+        # 共享的库句柄由 get_clib 负责初始化和关闭, 传入的句柄由实例自己管理
+        self._own_clib = clib is not None
+        if self._own_clib:
+            self.clib = clib
+            self.clib.ElememDev_Init()
+            self.clib.OpenMMIO()
+        else:
+            self.clib = get_clib()
 
         # print(self.clib)
         # print("!!!!!!!!!!!!")
-        self.clib.ElememDev_Init()
-        self.clib.OpenMMIO()
         self.irq_flag = 0
+        # 写权重完成事件, 由 SIGIO 处理函数置位
+        self.write_done = threading.Event()
 
     def __del__(self):
-        self.clib.CloseMMIO()
+        if getattr(self, '_own_clib', False):
+            self.clib.CloseMMIO()
 
     def irq_signal(self, signum, frame):
         self.irq_flag = 1
+        self.write_done.set()
 
     def switch_hd_version(self, on):
         self.writeReg(VERSION_TOGGLE, on)
 
+    @staticmethod
+    def _in_buffer(array):
+        """Return a C-contiguous version of array (no copy if it already is) and its data pointer."""
+        array = np.ascontiguousarray(array)
+        return array, array.ctypes.data_as(ctypes.c_void_p)
+
+    def _out_buffer(self, shape, dtype):
+        """Return a reusable output buffer from the pool and its data pointer.
+
+        The buffer is overwritten by the next call with the same shape and dtype,
+        so callers that keep the result must copy it.
+        """
+        key = (tuple(shape), np.dtype(dtype).str)
+        buffer = self._out_pool.pop(key, None)
+        if buffer is None:
+            buffer = np.empty(shape, dtype = dtype)
+            if len(self._out_pool) >= OUT_POOL_SIZE:
+                self._out_pool.pop(next(iter(self._out_pool)))
+        self._out_pool[key] = buffer
+        return buffer, buffer.ctypes.data_as(ctypes.c_void_p)
+
     def set_write_weight_config(self):
         self.writeReg(WRITE_WEIGHT_MAX_TOLERANCE, (1<<16))
         self.writeReg(WRITE_WEIGHT_SET_MAX_TIMES, 20)
@@ -160,61 +285,111 @@ class BaseAPI():
         self.writeReg(MAX_CLKNUM_WRITE_WEIGHT, 500000)
         self.writeReg(VERIFY_WEIGHT_MAX_TIMES, 0x0101)
 
-    def clearAllActualBitMap(self):
-        for dinNum in self.DINArr:
-            for din in dinNum:
-                din.actualBitMap = 0
-
     def cfgDIN(self):
-        reg = REG51_ADDR
-        for i in range(TOTAL_ROW // 32):
-            self.DIN0[0 + 4 * i].cfgPara(reg, 0x01000000)
-            self.DIN0[1 + 4 * i].cfgPara(reg, 0x00010000)
-            self.DIN0[2 + 4 * i].cfgPara(reg, 0x00000100)
-            self.DIN0[3 + 4 * i].cfgPara(reg, 0x00000001)
-
-            self.DIN1[0 + 4 * i].cfgPara(reg, 0x02000000)
-            self.DIN1[1 + 4 * i].cfgPara(reg, 0x00020000)
-            self.DIN1[2 + 4 * i].cfgPara(reg, 0x00000200)
-            self.DIN1[3 + 4 * i].cfgPara(reg, 0x00000002)
-
-            self.DIN2[0 + 4 * i].cfgPara(reg, 0x04000000)
-            self.DIN2[1 + 4 * i].cfgPara(reg, 0x00040000)
-            self.DIN2[2 + 4 * i].cfgPara(reg, 0x00000400)
-            self.DIN2[3 + 4 * i].cfgPara(reg, 0x00000004)
-
-            self.DIN3[0 + 4 * i].cfgPara(reg, 0x08000000)
-            self.DIN3[1 + 4 * i].cfgPara(reg, 0x00080000)
-            self.DIN3[2 + 4 * i].cfgPara(reg, 0x00000800)
-            self.DIN3[3 + 4 * i].cfgPara(reg, 0x00000008)
-
-            self.DIN4[0 + 4 * i].cfgPara(reg, 0x10000000)
-            self.DIN4[1 + 4 * i].cfgPara(reg, 0x00100000)
-            self.DIN4[2 + 4 * i].cfgPara(reg, 0x00001000)
-            self.DIN4[3 + 4 * i].cfgPara(reg, 0x00000010)
-
-            self.DIN5[0 + 4 * i].cfgPara(reg, 0x20000000)
-            self.DIN5[1 + 4 * i].cfgPara(reg, 0x00200000)
-            self.DIN5[2 + 4 * i].cfgPara(reg, 0x00002000)
-            self.DIN5[3 + 4 * i].cfgPara(reg, 0x00000020)
-
-            self.DIN6[0 + 4 * i].cfgPara(reg, 0x40000000)
-            self.DIN6[1 + 4 * i].cfgPara(reg, 0x00400000)
-            self.DIN6[2 + 4 * i].cfgPara(reg, 0x00004000)
-            self.DIN6[3 + 4 * i].cfgPara(reg, 0x00000040)
-
-            self.DIN7[0 + 4 * i].cfgPara(reg, 0x80000000)
-            self.DIN7[1 + 4 * i].cfgPara(reg, 0x00800000)
-            self.DIN7[2 + 4 * i].cfgPara(reg, 0x00008000)
-            self.DIN7[3 + 4 * i].cfgPara(reg, 0x00000080)
-            reg = reg - 4
+        """Precompute the DIN lookup for the 1152 physical rows.
+
+        Physical row r lives in channel r // 144. Within a channel, rows are
+        packed four per byte lane of the register REG51_ADDR - 4 * (r % 144 // 4);
+        channel c uses bit c of each byte lane.
+        dinRegIdx[r] is that register's index (address REG51_ADDR - 4 * index)
+        and dinBitMask[r] its bit mask.
+        """
+        rowIndex = np.arange(TOTAL_ROW)
+        channel = rowIndex // ONE_CHANNEL_ROW
+        rowInChannel = rowIndex % ONE_CHANNEL_ROW
+        self.dinRegIdx = rowInChannel // 4
+        lane = rowInChannel % 4
+        self.dinBitMask = (np.uint64(0x01000000) >> (8 * lane).astype(np.uint64)) << channel.astype(np.uint64)
+        self.dinRegAddr = [REG51_ADDR - 4 * i for i in range(TOTAL_ROW // 32)]
+
+    def writeDIN(self, rowIndex):
+        """Write the 36 DIN registers so that exactly the given physical rows are selected."""
+        # 同一寄存器中不同行的 bit 互不重叠, 按位或等于求和
+        words = np.bincount(self.dinRegIdx[rowIndex], weights = self.dinBitMask[rowIndex],
+                            minlength = TOTAL_ROW // 32).astype(np.uint64)
+        with self.batchWrites():
+            for regAddr, word in zip(self.dinRegAddr, words.tolist()):
+                self.writeReg(regAddr, word)
 
     def writeReg(self, addr, value):
+        if self._pending_writes is not None:
+            self._pending_writes.append((addr, value))
+            return
+        self._writeRegThrough(addr, value)
+
+    def _writeRegThrough(self, addr, value):
+        volatile = addr in self.volatile_regs
+        if self.shadow_enabled and not volatile and self._shadow.get(addr) == value:
+            self.reg_stats['skipped'] += 1
+            return
+        self.mmio.write(addr, value)
+        self.reg_stats['writes'] += 1
+        if not volatile:
+            self._shadow[addr] = value
+
+    def writeRegVolatile(self, addr, value):
+        """Write a register bypassing the shadow cache and any pending batch."""
+        self.flushWrites()
         self.mmio.write(addr, value)
+        self.reg_stats['writes'] += 1
+        self._shadow.pop(addr, None)
 
     def readReg(self, addr):
+        # 读之前先把尚未写出的寄存器写完, 保证读写顺序
+        if self._pending_writes:
+            self.flushWrites()
+        self.reg_stats['reads'] += 1
         return self.mmio.read(addr)
 
+    @contextmanager
+    def batchWrites(self):
+        """Collect register writes and flush them in one pass on exit.
+
+        Repeated writes to a non-volatile register collapse to the last value
+        written before the next volatile write, and writes that do not change
+        the register are dropped. Volatile writes keep their order. Reads
+        inside the block flush first.
+        """
+        if self._pending_writes is not None:
+            yield
+            return
+        self._pending_writes = []
+        try:
+            yield
+        finally:
+            self.flushWrites()
+            self._pending_writes = None
+
+    def flushWrites(self):
+        if not self._pending_writes:
+            return
+        pending = self._pending_writes
+        self._pending_writes = []
+        # 两次 volatile 写之间, 同一配置寄存器只保留最后一次写入的值
+        latest = {}
+        for addr, value in pending:
+            if addr in self.volatile_regs:
+                for reg, val in latest.items():
+                    self._writeRegThrough(reg, val)
+                latest.clear()
+                self._writeRegThrough(addr, value)
+            else:
+                latest[addr] = value
+        for reg, val in latest.items():
+            self._writeRegThrough(reg, val)
+
+    def invalidateShadow(self, addr = None):
+        """Forget cached register values, e.g. after the C library or a reset touched them."""
+        if addr is None:
+            self._shadow.clear()
+        else:
+            self._shadow.pop(addr, None)
+
+    def switch_mode(self, mode):
+        self.flushWrites()
+        self.clib.ElememDev_SwitchMode(mode)
+        self.invalidateShadow()
+
     # def getAdcValue(self, regVal, colIdx):
     #     idx = colIdx % 8
     #     adcVal = (regVal >> ((7 - idx) * 4)) & 0xF
@@ -238,14 +413,15 @@ class BaseAPI():
 
     def selectOneCol(self, colIdx):
         assert 0 <= colIdx < TOTAL_COL
-        self.writeReg(REG52_ADDR + 4 * 0, 0)
-        self.writeReg(REG52_ADDR + 4 * 1, 0)
-        self.writeReg(REG52_ADDR + 4 * 2, 0)
-        self.writeReg(REG52_ADDR + 4 * 3, 0)
         regNum = colIdx // 32
         remainder = colIdx % 32
         regVal = 1 << (31 - remainder)
-        self.writeReg(REG55_ADDR - 4 * regNum, regVal)
+        with self.batchWrites():
+            self.writeReg(REG52_ADDR + 4 * 0, 0)
+            self.writeReg(REG52_ADDR + 4 * 1, 0)
+            self.writeReg(REG52_ADDR + 4 * 2, 0)
+            self.writeReg(REG52_ADDR + 4 * 3, 0)
+            self.writeReg(REG55_ADDR - 4 * regNum, regVal)
 
     def selectOneRow(self, rowIdx, POS_or_NEG):
         assert POS_or_NEG == 'POS' or POS_or_NEG == 'NEG'
@@ -444,13 +620,15 @@ class BaseAPI():
             ____|-------------|-ti-|________  KEEP_INTEG
         '''
         regVal = tb | (ts << 8) | (ti << 16)
-        self.writeReg(REG6_ADDR, regVal)
-        self.writeReg(REG56_ADDR, te)
+        with self.batchWrites():
+            self.writeReg(REG6_ADDR, regVal)
+            self.writeReg(REG56_ADDR, te)
 
     def resetSystem(self):
         self.writeReg(REG2_ADDR, 1)
         time.sleep(0.01)
         self.writeReg(REG2_ADDR, 0)
+        self.invalidateShadow()
 
     def powerOn(self):
         self.opFlow(OP_POWER_ON)
@@ -460,53 +638,17 @@ class BaseAPI():
 
     def selectRows(self, rowData):
         assert len(rowData) == (TOTAL_ROW // 2)
-        self.clearAllActualBitMap()
-        for idx, data in enumerate(rowData):
-            if data == 1:
-                rowIndex = idx * 2
-                channel = rowIndex // 144
-                din = self.DINArr[channel]
-                din[rowIndex % 144].actualBitMap = din[rowIndex %
-                                                       144].selectedBitMap
-
-        for i in range(TOTAL_ROW // 32):
-            v = 0
-            for j in range(TOTAL_CHANNEL):
-                v = v | self.DINArr[j][0 + 4 * i].actualBitMap
-                v = v | self.DINArr[j][1 + 4 * i].actualBitMap
-                v = v | self.DINArr[j][2 + 4 * i].actualBitMap
-                v = v | self.DINArr[j][3 + 4 * i].actualBitMap
-                self.writeReg(self.DINArr[0][0 + 4 * i].regAddr, v)
+        rowData = np.asarray(rowData)
+        self.writeDIN(np.flatnonzero(rowData == 1) * 2)
 
     def selectInput(self, inputData):
         assert len(inputData) == (TOTAL_ROW // 2)
-        self.clearAllActualBitMap()
-        for idx, data in enumerate(inputData):
-            if data == -1:
-                rowIndex = idx * 2
-                channel = rowIndex // 144
-                din = self.DINArr[channel]
-                din[rowIndex % 144].actualBitMap = din[rowIndex %
-                                                       144].selectedBitMap
-            elif data == 1:
-                rowIndex = idx * 2 + 1
-                channel = rowIndex // 144
-                din = self.DINArr[channel]
-                din[rowIndex % 144].actualBitMap = din[rowIndex %
-                                                       144].selectedBitMap
-            elif data == 0:
-                pass
-            else:
-                raise ValueError('The element of inputData must be -1, 0, 1')
-
-        for i in range(TOTAL_ROW // 32):
-            v = 0
-            for j in range(TOTAL_CHANNEL):
-                v = v | self.DINArr[j][0 + 4 * i].actualBitMap
-                v = v | self.DINArr[j][1 + 4 * i].actualBitMap
-                v = v | self.DINArr[j][2 + 4 * i].actualBitMap
-                v = v | self.DINArr[j][3 + 4 * i].actualBitMap
-                self.writeReg(self.DINArr[0][0 + 4 * i].regAddr, v)
+        inputData = np.asarray(inputData)
+        neg = inputData == -1
+        pos = inputData == 1
+        if not (neg | pos | (inputData == 0)).all():
+            raise ValueError('The element of inputData must be -1, 0, 1')
+        self.writeDIN(np.concatenate([np.flatnonzero(neg) * 2, np.flatnonzero(pos) * 2 + 1]))
 
     # def calcArray(self, rowInput, colStart, colCount):
     #     """calculate Selected cells.
@@ -755,6 +897,7 @@ class BaseAPI():
         self.cfgFormVWL(1.871)
         self.set_write_weight_config()
         self.clib.ElememDev_WriteInitVol()
+        self.invalidateShadow()
 
     def selectChip(self, chipNum):
         """Select the chip.
@@ -916,19 +1059,20 @@ class BaseAPI():
         Returns:
             result: numpy.ndarray, two-axis matrix
                     The element of result is ADC value, 0 <= result < 16
+                    A view of a pooled buffer, copy it to keep it across calls.
         """
         assert (rowInput.dtype == 'uint8') or (rowInput.dtype == 'int8')
         # self.cfgCalcTimePara()
-        bRowInput = bytes(rowInput)
+        rowInput, pRowInput = self._in_buffer(rowInput)
         calcCount = int(rowInput.shape[0])
         rowCount = int(rowInput.shape[1])
-        output = bytes(colCount * calcCount * [0])
-        ret = self.clib.CalcArray_2(bRowInput, rowStart, rowCount, colStart,
-                                    colCount, output, calcCount)
+        output, pOutput = self._out_buffer((calcCount, colCount), np.uint8)
+        self.flushWrites()
+        ret = self.clib.CalcArray_2(pRowInput, rowStart, rowCount, colStart,
+                                    colCount, pOutput, calcCount)
+        self.invalidateShadow()
         if ret != 0:
             raise Exception('CalcArray_2() return error')
-        output = np.frombuffer(output, dtype = np.uint8)
-        output.resize(calcCount, colCount)
         # self.cfgMapTimePara()
         return output
 
@@ -1663,12 +1807,14 @@ class BaseAPI():
             output: weight
         """
         type_is_2t2r = 0
-        output = bytes(rowCount * colCount * [0])
-        ret = self.clib.ElememDev_ReadWeight(rowStart,colStart,rowCount,colCount, output, type_is_2t2r, time_out_ms)
+        # 读出的权重通常会被保存, 不使用缓冲池
+        output = np.empty([rowCount, colCount], dtype = np.uint8)
+        self.flushWrites()
+        ret = self.clib.ElememDev_ReadWeight(rowStart,colStart,rowCount,colCount,
+                                             output.ctypes.data_as(ctypes.c_void_p), type_is_2t2r, time_out_ms)
+        self.invalidateShadow()
         if ret != 0:
             raise Exception('ElememDev_ReadWeight() return error')
-        output = np.frombuffer(output, dtype = np.uint8)
-        output.resize(rowCount, colCount)
 
         return output
 
@@ -1690,12 +1836,16 @@ class BaseAPI():
         # call this fun must check the weight value : 0 <= result < 16
         assert (weightInput.dtype == 'uint8') or (weightInput.dtype == 'int8')
         data_is_zero = 0
-        bweightInput = bytes(weightInput)
+        weightInput, pWeightInput = self._in_buffer(weightInput)
         rowCount = int(weightInput.shape[0])
         colCount = int(weightInput.shape[1])
         #print("weight data shape:", rowCount,colCount)
         signal.signal(signal.SIGIO, self.irq_signal)
-        ret = self.clib.ElememDev_WriteWeight(rowStart,colStart,rowCount,colCount, data_is_zero, bweightInput, time_out_s)
+        self.irq_flag = 0
+        self.write_done.clear()
+        self.flushWrites()
+        ret = self.clib.ElememDev_WriteWeight(rowStart,colStart,rowCount,colCount, data_is_zero, pWeightInput, time_out_s)
+        self.invalidateShadow()
         if ret != 0:
             raise Exception('write_chip_weight() return error')
         return True
@@ -1722,18 +1872,19 @@ class BaseAPI():
         Returns:
             result: numpy.ndarray, two-axis matrix
                     The element of result(int16)
+                    A view of a pooled buffer, copy it to keep it across calls.
         """
         assert (rowInput.dtype == 'uint8') or (rowInput.dtype == 'int8')
-        bRowInput = bytes(rowInput)
+        rowInput, pRowInput = self._in_buffer(rowInput)
         calcCount = int(rowInput.shape[0])
         rowCount = int(rowInput.shape[1])
-        output = bytes(colCount * calcCount *2 * [0] )
-        ret = self.clib.ElememDev_CalcArray(bRowInput, rowStart, rowCount, colStart, colCount,
-                                            output, calcCount, data_type, split_mode, time_out_ms)
+        output, pOutput = self._out_buffer((calcCount, colCount), np.int16)
+        self.flushWrites()
+        ret = self.clib.ElememDev_CalcArray(pRowInput, rowStart, rowCount, colStart, colCount,
+                                            pOutput, calcCount, data_type, split_mode, time_out_ms)
+        self.invalidateShadow()
         if ret != 0:
             raise Exception('elemem_calc_array() return error')
-        output = np.frombuffer(output, dtype = np.int16)
-        output.resize(calcCount, colCount)
 
         return output
 
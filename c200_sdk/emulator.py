@@ -0,0 +1,176 @@
+import os
+import threading
+
+import numpy as np
+
+TOTAL_ROW = 576
+TOTAL_COL = 128
+
+ADC_BITS = 4
+ADC_OFFSET = 8  # ADC 码值 8 对应 0
+ADC_MAX = 2 ** ADC_BITS - 1
+
+WEIGHT_MAX = 15
+WEIGHT_ZERO = 8  # 电导码值 8 对应权重 0
+
+
+class EmulatorAPI():
+    """A NumPy model of the 576x128 crossbar with the BaseAPI interface used by SDKArray.
+
+    Every virtual chip stores one conductance code (0..15, 8 means weight 0)
+    per cell. A calculation integrates (input @ (G - 8)) and converts it with a
+    4-bit ADC centred at code 8:
+
+        adc = clip(round(acc * it_time * adc_gain + read_noise), -8, 7)
+
+    Programming lands on target + N(0, prog_noise) and is counted in the same
+    write-status counters the hardware exposes.
+
+    Args:
+        chips: int
+                Number of virtual chips, selected with selectChip.
+        prog_noise: float
+                Standard deviation of the programmed conductance, in ADC codes.
+        read_noise: float
+                Standard deviation of the ADC input noise, in ADC codes.
+        adc_gain: float
+                ADC codes per unit of integrated current per unit of it_time.
+        init_state: int or numpy.ndarray
+                Initial conductance codes of every chip.
+        seed: int
+                Seed of the noise generator.
+    """
+    version = "emulator"
+
+    def __init__(self, chips = 12, prog_noise = 0.0, read_noise = 0.0, adc_gain = 0.1,
+                 init_state = WEIGHT_ZERO, seed = None):
+        self.prog_noise = prog_noise
+        self.read_noise = read_noise
+        self.adc_gain = adc_gain
+        self.rng = np.random.default_rng(seed)
+        self.states = [np.full([TOTAL_ROW, TOTAL_COL], init_state, dtype = np.float64) for _ in range(chips)]
+        self.chip = 0
+        self.it_time = 5
+        self.hd_version = 0
+        self.mode = 0
+        self.irq_flag = 0
+        self.write_done = threading.Event()
+        self.write_status = (0, 0, 0, 0)
+        self.counters = dict(calc_calls = 0, pulses = 0, write_calls = 0, read_calls = 0, select_calls = 0)
+
+    @property
+    def conductance(self):
+        return self.states[self.chip]
+
+    # ================================= #
+    # 配置
+    # ================================= #
+    def devInit(self):
+        self.it_time = 63
+
+    def selectChip(self, chipNum):
+        assert 0 <= chipNum < len(self.states)
+        self.chip = chipNum
+        self.counters['select_calls'] += 1
+
+    def cfgReadPulse(self, ti = 0x20, ts = 0x28, tb = 0xFF, te = 0x3C):
+        self.it_time = ti
+
+    def switch_hd_version(self, on):
+        self.hd_version = on
+
+    def switch_mode(self, mode):
+        self.mode = mode
+
+    # ================================= #
+    # 计算
+    # ================================= #
+    def _adc(self, acc):
+        adc = acc * (self.it_time * self.adc_gain)
+        if self.read_noise:
+            adc = adc + self.rng.normal(0, self.read_noise, size = adc.shape)
+        return np.clip(np.rint(adc), -ADC_OFFSET, ADC_MAX - ADC_OFFSET)
+
+    def elemem_calc_array(self, rowInput: np.ndarray, rowStart, rowCount, colStart, colCount,
+                          data_type = 0, split_mode = 0, time_out_ms = 1000):
+        """Same contract as BaseAPI.elemem_calc_array: int16 results, ADC code minus 8 for data_type 0."""
+        assert (rowInput.dtype == 'uint8') or (rowInput.dtype == 'int8')
+        calcCount = int(rowInput.shape[0])
+        weight = self.conductance[rowStart:rowStart + rowCount, colStart:colStart + colCount] - WEIGHT_ZERO
+        acc = rowInput.astype(np.float64) @ weight
+        self.counters['calc_calls'] += 1
+        self.counters['pulses'] += calcCount
+        if data_type == 0:
+            return self._adc(acc).astype(np.int16)
+        return np.rint(acc).astype(np.int16)
+
+    def calc_array(self, addr, input):
+        rowstart, rowcount, colstart, colcount = addr
+        output = self.elemem_calc_array(np.asarray(input).astype(np.int8), rowstart, rowcount, colstart, colcount)
+        return (output + ADC_OFFSET).astype(np.uint8)
+
+    def calcOneCell(self, rowIdx, colIdx, POS_or_NEG = 'POS'):
+        return int(np.clip(np.rint(self.conductance[rowIdx, colIdx]), 0, WEIGHT_MAX))
+
+    def readOneCell(self, rowIdx, colIdx, POS_or_NEG):
+        # 2T2R 中正/负器件分别承担高于/低于 8 的部分
+        code = self.calcOneCell(rowIdx, colIdx)
+        if POS_or_NEG == 'POS':
+            return max(code, WEIGHT_ZERO)
+        return max(2 * WEIGHT_ZERO - code, WEIGHT_ZERO)
+
+    # ================================= #
+    # 权重读写
+    # ================================= #
+    def elemem_read_weight(self, rowStart, rowCount, colStart, colCount, time_out_ms = 16 * 1000):
+        self.counters['read_calls'] += 1
+        weight = self.conductance[rowStart:rowStart + rowCount, colStart:colStart + colCount]
+        return np.clip(np.rint(weight), 0, WEIGHT_MAX).astype(np.uint8)
+
+    def _program(self, target, rowStart, colStart):
+        rowCount, colCount = target.shape
+        region = self.conductance[rowStart:rowStart + rowCount, colStart:colStart + colCount]
+        unchanged = np.rint(region) == target
+        programmed = target + self.rng.normal(0, self.prog_noise, size = target.shape) \
+            if self.prog_noise else target.astype(np.float64)
+        programmed = np.clip(programmed, 0, WEIGHT_MAX)
+        region[~unchanged] = programmed[~unchanged]
+        passed = np.rint(region) == target
+        return unchanged, passed
+
+    def elemem_write_weight(self, weightInput: np.ndarray, rowStart, colStart, time_out_s = 20 * 60):
+        """Program a block; completes synchronously and raises irq_flag / write_done like the SIGIO handler would."""
+        assert (weightInput.dtype == 'uint8') or (weightInput.dtype == 'int8')
+        self.write_done.clear()
+        self.counters['write_calls'] += 1
+        unchanged, passed = self._program(weightInput.astype(np.float64), rowStart, colStart)
+        cell_total_num = int(weightInput.size)
+        cell_unchanged_num = int(unchanged.sum())
+        cell_right_num = int((passed & ~unchanged).sum())
+        self.write_status = (cell_total_num, cell_right_num, cell_unchanged_num, 0)
+        self.irq_flag = 1
+        self.write_done.set()
+        return True
+
+    def get_write_weight_status(self):
+        cell_processed, cell_pass_num, cell_unchanged_num, cell_timeout_num = self.write_status
+        cell_pass_num = cell_pass_num + cell_unchanged_num
+        return cell_processed, cell_pass_num, cell_unchanged_num, cell_timeout_num
+
+    def map_single_device_2T2R(self, rowIdx, colIdx, target_adc, tolerance = 0, try_limit = 500,
+                               strategy = 0, with_form = 3, verbose = 0):
+        _, passed = self._program(np.full([1, 1], target_adc, dtype = np.float64), rowIdx, colIdx)
+        return int(passed.all())
+
+    def map_single_device_2T2R_POR(self, rowIdx, colIdx, target_adc, tolerance = 0, try_limit = 500,
+                                   strategy = 0, with_form = 3, verbose = 0):
+        return self.map_single_device_2T2R(rowIdx, colIdx, target_adc, tolerance = tolerance)
+
+
+def emulator_from_env():
+    """Build an EmulatorAPI from the C200_EMU_* environment variables."""
+    return EmulatorAPI(chips = int(os.environ.get('C200_EMU_CHIPS', 12)),
+                       prog_noise = float(os.environ.get('C200_EMU_PROG_NOISE', 0.0)),
+                       read_noise = float(os.environ.get('C200_EMU_READ_NOISE', 0.0)),
+                       adc_gain = float(os.environ.get('C200_EMU_ADC_GAIN', 0.1)),
+                       seed = int(os.environ['C200_EMU_SEED']) if 'C200_EMU_SEED' in os.environ else None)
@@ -5,10 +5,12 @@ import numpy
 from sys import stderr
 import csv
 from c200_sdk import base_api
+from c200_sdk import emulator
 import time
 # from lib.npu_array import Device
 import os
 import datetime
+from contextlib import contextmanager
 
 
 # import winsound
@@ -32,6 +34,10 @@ def log_proc(mode, current, total):
     print('@', mode, '...', current, '/', total, end = '\r', file = stderr, flush = True)
 
 
+def print_write_progress(cell_processed, cell_total_num):
+    print(f'\rProgress at {cell_processed/cell_total_num * 100:.2f} %',end = '')
+
+
 class ReRAM144KProfile:
     input_size = 576  # 1152 // 2
     input_bits = 1  # [-1, 1]
@@ -67,6 +73,26 @@ class SDKArray:
 
     SELECT_DELAY = 0.5
 
+    # 等待写权重完成: 等待间隔从 WRITE_POLL_MIN 倍增到 WRITE_POLL_MAX, 进度回调至多每 WRITE_PROGRESS_INTERVAL 秒一次
+    WRITE_POLL_MIN = 0.001
+    WRITE_POLL_MAX = 0.1
+    WRITE_PROGRESS_INTERVAL = 0.5
+
+    # 增量 / 校验写权重: 相距不超过 REWRITE_MAX_GAP 行 (列) 的不匹配 cell 合并到同一矩形,
+    # 矩形面积 / 其中不匹配的 cell 数不超过 REWRITE_MAX_COVER 时整块写入;
+    # 剩下分散的 cell 不超过 REWRITE_MAX_CELLS 个时才逐个编程, 否则按代价选择整块写入它们的包围盒
+    REWRITE_MAX_GAP = 1
+    REWRITE_MAX_COVER = 2.0
+    REWRITE_MAX_CELLS = 16
+    # 重写代价 (以块写入中写一个 cell 为单位): 每次块写入命令的固定开销, 块写入中 FPGA 跳过一个已正确 cell,
+    # 以及 program() 逐个编程一个 cell (host 上的 ISPP 循环, 每个脉冲都要多次寄存器读写)
+    REWRITE_BLOCK_COST = 64
+    REWRITE_SKIP_COST = 0.1
+    REWRITE_PROGRAM_COST = 200
+
+    # 后端选择: 'hardware' 为板上 BaseAPI, 'emulator' 为纯软件的 EmulatorAPI
+    BACKEND_ENV = 'C200_SDK_BACKEND'
+
     c = 1  # 积分时间常数
 
     dtype = 'int32'
@@ -83,13 +109,83 @@ class SDKArray:
     _wl_after = 255
     _ctrl_delay = 60
 
+    # session 模式下缓存最近一次写入的寄存器配置, 配置不变时跳过写寄存器
+    _session_depth = 0
+    _read_pulse = None  # (it_time, wl_pre, wl_after, ctrl_delay)
+    _hd_version = None
+    session_stats = dict(read_pulse_writes = 0, read_pulse_skipped = 0,
+                         hd_version_writes = 0, hd_version_skipped = 0)
+
     @classmethod
     def status(cls):
         return dict(sdk = cls._sdk is not None, board = cls._id)
 
     @classmethod
-    def connect(cls):
+    @contextmanager
+    def session(cls):
+        '''
+        session 模式: 在 with 块内只在配置变化时写积分时间和 HD version 寄存器,
+        calculate 结束后不再切回 HD version 0, 而是在退出 session 时切回一次
+        可以嵌套, 最外层退出时恢复
+        '''
+        if cls._session_depth == 0:
+            cls._read_pulse = None
+            cls._hd_version = None
+        cls._session_depth += 1
+        try:
+            yield cls.session_stats
+        finally:
+            cls._session_depth -= 1
+            if cls._session_depth == 0:
+                if cls._hd_version == 1:
+                    cls._sdk.switch_hd_version(0)
+                    cls.session_stats['hd_version_writes'] += 1
+                cls._read_pulse = None
+                cls._hd_version = None
+
+    @classmethod
+    def in_session(cls):
+        return cls._session_depth > 0
+
+    @classmethod
+    def reset_session_stats(cls):
+        for key in cls.session_stats:
+            cls.session_stats[key] = 0
+
+    @classmethod
+    def switch_hd_version(cls, on):
+        if cls.in_session() and cls._hd_version == on:
+            cls.session_stats['hd_version_skipped'] += 1
+            return
+        cls._sdk.switch_hd_version(on)
+        cls.session_stats['hd_version_writes'] += 1
+        cls._hd_version = on
+
+    @classmethod
+    def connect(cls, backend = None):
+        '''
+        backend: None / 'hardware' / 'emulator' / 已构造的后端对象
+        为 None 时由环境变量 C200_SDK_BACKEND 决定, 默认 'hardware'
+        传入后端对象时总是替换当前后端
+        '''
+        if isinstance(backend, str):
+            if backend not in ('hardware', 'emulator'):
+                raise ValueError(f'unknown backend {backend!r}')
+            if cls._sdk is not None and cls.is_emulator() != (backend == 'emulator'):
+                cls._sdk = None
+        elif backend is not None:
+            cls._sdk = None
         if cls._sdk is None:
+            cls._id = None
+            cls._read_pulse = None
+            cls._hd_version = None
+            backend = backend or os.environ.get(cls.BACKEND_ENV, 'hardware')
+            if not isinstance(backend, str):
+                cls._sdk = backend
+                return
+            if backend == 'emulator':
+                cls._sdk = emulator.emulator_from_env()
+                return
             # sdk = SDK()
             # sdk = SDK.get_instance(Device.RAW)
             # if not sdk.connect_device():
@@ -113,33 +209,48 @@ class SDKArray:
         print('初始化')
         cls._sdk.selectChip(id)
         print('选片')
-        sleep(cls.SELECT_DELAY)
+        if not cls.is_emulator():
+            sleep(cls.SELECT_DELAY)
         cls._id = id
+        # devInit 重新配置了寄存器, 缓存失效
+        cls._read_pulse = None
+        cls._hd_version = None
         #debug(f'切换到测试板 {id}')
 
 
     @classmethod
     def is_emulator(cls):
-        return False
+        return isinstance(cls._sdk, emulator.EmulatorAPI)
 
     @classmethod
     def set_intergration_time(cls, it_time, wl_pre, wl_after, ctrl_delay):
+        read_pulse = (it_time, wl_pre, wl_after, ctrl_delay)
+        if cls.in_session() and cls._read_pulse == read_pulse:
+            cls.session_stats['read_pulse_skipped'] += 1
+            return
         cls._sdk.cfgReadPulse(ti = it_time, ts = wl_pre, tb = wl_after, te = ctrl_delay)
+        cls.session_stats['read_pulse_writes'] += 1
+        cls._read_pulse = read_pulse
 
     @classmethod
     def set_wl_pre_time(cls, time):
         cls._sdk.cfgReadPulse(ts = time)
+        cls._read_pulse = None
 
     @classmethod
     def set_wl_after_time(cls, time):
         cls._sdk.cfgReadPulse(tb = time)
+        cls._read_pulse = None
 
     @classmethod
     def set_ctrl_delay_time(cls, time):
         cls._sdk.cfgReadPulse(te = time)
+        cls._read_pulse = None
 
-    def __init__(self, id):
+    def __init__(self, id, backend = None):
         # assert id > 0
+        if backend is not None:
+            self.connect(backend)
         self.select(id)
         self.id = id
         self.version = self._sdk.version
@@ -157,21 +268,24 @@ class SDKArray:
 
     def get_weight(self, addr = None, verbose = 1):
         '获取区域权重'
-        self._sdk.clib.ElememDev_SwitchMode(1)
+        self.select(self.id)
+        # session 中 calculate 之后 HD version 可能仍为 1, 读权重前切回
+        if self._hd_version == 1:
+            self.switch_hd_version(0)
+        self._sdk.switch_mode(1)
         addr = self.to_sdk_addr(addr)
         # print(addr)
         rowstart = addr[0]
         rowcount = addr[1]
         colstart = addr[2]
         colcount = addr[3]
-        self.select(self.id)
         self.set_intergration_time(63, 40, 255, 60)
 
         if verbose == True:
             print('')
         start = time.time()
         weight = self._sdk.elemem_read_weight(rowstart, rowcount, colstart, colcount)
-        self._sdk.clib.ElememDev_SwitchMode(0)
+        self._sdk.switch_mode(0)
         elapsed = (time.time() - start)
         weight = weight.astype(numpy.int8)
         if verbose == True:
@@ -189,25 +303,24 @@ class SDKArray:
 
     def set_weight(self, weight, addr = None, form = False, quant = True, prog_cycle = 5,
                    verbose = 1, detail = False,
-                        return_log = 0):
-        'Map/Form 权重'
+                        return_log = 0, incremental = False, tolerance = 0):
+        '''
+        Map/Form 权重
+        incremental: 增量模式, 每个 cycle 先读回区域, 只重写与目标相差超过 tolerance 的 cell
+                     (合并为矩形块写入, 分散的 cell 逐个编程, 见 plan_rewrite), 全部匹配时提前结束
+        '''
         assert quant
-        self._sdk.clib.ElememDev_SwitchMode(1)
-        weight = numpy.asarray(weight).astype(numpy.int8)
-        #weight[weight == 0] = 8
-        addr = self.to_sdk_addr(addr)
-        rowstart = addr[0]
-        rowcount = addr[1]
-        colstart = addr[2]
-        colcount = addr[3]
-        shape = (rowcount, colcount)
-        H, W = self.shape
-        self.check_weight(weight, shape)
+        weight, addr = self._begin_write(weight, addr)
+        rowstart, rowcount, colstart, colcount = addr
         print(weight.shape)
-        self.select(self.id)
-        self.set_intergration_time(63, 40, 255, 60)
         cell_total_num = rowcount * colcount
         print(f"cell_total_num:{cell_total_num}")
+        if incremental:
+            log = self._set_weight_incremental(weight, rowstart, colstart, prog_cycle, tolerance, verbose)
+            self._sdk.switch_mode(0)
+            if return_log:
+                return log
+            return
         mapping_success_rate_list = []
         operation_success_rate_list = []
         time_start = time.time()
@@ -216,14 +329,8 @@ class SDKArray:
             print(f'=======================================')
             print(f'Cycle = {cycle}')
             print(f'=======================================')
-            self._sdk.irq_flag = 0
-            cell_processed = 0
-            self._sdk.elemem_write_weight(weight, rowstart, colstart)
-            while self._sdk.irq_flag != 1 or cell_processed < cell_total_num:
-                time.sleep(0.001)
-                cell_processed, cell_pass_num, cell_unchanged_num, cell_timeout_num = self._sdk.get_write_weight_status()
-                print(f'\rProgress at {cell_processed/cell_total_num * 100:.2f} %',end = '')
-            print("")
+            cell_processed, cell_pass_num, cell_unchanged_num, cell_timeout_num = \
+                self._write_block(weight, rowstart, colstart)
 
             time_elapsed = (time.time() - time_start)
             # print(cell_processed, cell_pass_num, cell_unchanged_num, cell_timeout_num)
@@ -238,7 +345,7 @@ class SDKArray:
             print(f'Operation success rate: {cell_pass_num - cell_unchanged_num} / '
                   f'{cell_total_num - cell_unchanged_num}, {operation_success_rate:.4f}')
 
-        self._sdk.clib.ElememDev_SwitchMode(0)
+        self._sdk.switch_mode(0)
 
         mapping_success_rate_list.append(mapping_success_rate)
         operation_success_rate_list.append(operation_success_rate)
@@ -246,6 +353,290 @@ class SDKArray:
         if return_log:
             return mapping_success_rate_list, operation_success_rate_list
 
+    def _begin_write(self, weight, addr):
+        '''
+        进入写权重模式并检查权重, 返回 (int8 权重, sdk 地址 (rowstart, rowcount, colstart, colcount))
+        结束时需调用 self._sdk.switch_mode(0)
+        '''
+        self.select(self.id)
+        # session 中 calculate 之后 HD version 可能仍为 1, 写权重前切回
+        if self._hd_version == 1:
+            self.switch_hd_version(0)
+        self._sdk.switch_mode(1)
+        weight = numpy.asarray(weight).astype(numpy.int8)
+        #weight[weight == 0] = 8
+        addr = self.to_sdk_addr(addr)
+        self.check_weight(weight, (addr[1], addr[3]))
+        self.set_intergration_time(63, 40, 255, 60)
+        return weight, addr
+
+    def _write_block(self, weight, rowstart, colstart, progress = True):
+        '''
+        写入一块权重并等待完成, 需已处于写权重模式 (switch_mode(1))
+        返回 (cell_processed, cell_pass_num, cell_unchanged_num, cell_timeout_num)
+        '''
+        self.write_block_async(weight, rowstart, colstart)
+        status = self.wait_write_block(weight.shape[0] * weight.shape[1],
+                                       progress = print_write_progress if progress else None)
+        if progress:
+            print("")
+        return status
+
+    def write_block_async(self, weight, rowstart, colstart):
+        '''
+        提交一块权重的写操作, 不等待完成, 需已处于写权重模式 (switch_mode(1))
+        完成时 SIGIO 处理函数置位 self._sdk.write_done, 之后用 wait_write_block 等待
+        '''
+        self._sdk.elemem_write_weight(weight, rowstart, colstart)
+
+    def wait_write_block(self, cell_total_num, progress = None, timeout = None):
+        '''
+        等待写权重完成: 在 write_done 事件上等待, 等待间隔逐次加倍,
+        只在事件置位或需要报告进度时读取写状态寄存器
+        Args:
+            progress: progress(cell_processed, cell_total_num), 至多每 WRITE_PROGRESS_INTERVAL 秒调用一次,
+                完成时再调用一次
+            timeout: float, 超时秒数, None 为一直等待
+        Returns:
+            (cell_processed, cell_pass_num, cell_unchanged_num, cell_timeout_num)
+        '''
+        write_done = self._sdk.write_done
+        interval = self.WRITE_POLL_MIN
+        time_start = last_report = time.perf_counter()
+        while True:
+            done = write_done.wait(interval)
+            now = time.perf_counter()
+            report_due = progress is not None and now - last_report >= self.WRITE_PROGRESS_INTERVAL
+            if done or report_due:
+                status = self._sdk.get_write_weight_status()
+                if done and status[0] >= cell_total_num:
+                    if progress is not None:
+                        progress(status[0], cell_total_num)
+                    return status
+                if report_due:
+                    progress(status[0], cell_total_num)
+                    last_report = now
+                # 中断已到但计数尚未更新完
+                if done:
+                    time.sleep(interval)
+            if timeout is not None and now - time_start > timeout:
+                raise SDKError('elemem_write_weight', '等待写权重完成', cell_total_num)
+            interval = min(interval * 2, self.WRITE_POLL_MAX)
+
+    def set_weight_async(self, weight, addr = None):
+        '''
+        提交整块权重的写操作后立即返回, host 可以在写入期间准备下一块权重 (但不能使用芯片),
+        之后调用 wait_set_weight(handle) 等待完成并退出写权重模式
+        '''
+        weight, addr = self._begin_write(weight, addr)
+        self.write_block_async(weight, addr[0], addr[2])
+        return dict(addr = addr, cell_total_num = addr[1] * addr[3])
+
+    def wait_set_weight(self, handle, progress = None, timeout = None):
+        '等待 set_weight_async 提交的写操作完成, 返回写状态'
+        try:
+            return self.wait_write_block(handle['cell_total_num'], progress = progress, timeout = timeout)
+        finally:
+            self._sdk.switch_mode(0)
+
+    def _read_block(self, rowstart, rowcount, colstart, colcount):
+        '读回一块权重, 需已处于写权重模式 (switch_mode(1))'
+        return self._sdk.elemem_read_weight(rowstart, rowcount, colstart, colcount).astype(numpy.int16)
+
+    @staticmethod
+    def mismatch_mask(current, weight, tolerance = 0):
+        '读回值与目标相差超过 tolerance 的 cell'
+        return numpy.abs(numpy.asarray(current, dtype = numpy.int16) - weight) > tolerance
+
+    @staticmethod
+    def _index_runs(index, max_gap):
+        '把有序下标按间隔 (> max_gap 个空位) 分段, 返回 [(start, stop), ...]'
+        breaks = numpy.flatnonzero(numpy.diff(index) > max_gap + 1)
+        starts = numpy.r_[index[0], index[breaks + 1]]
+        stops = numpy.r_[index[breaks], index[-1]] + 1
+        return list(zip(starts.tolist(), stops.tolist()))
+
+    @staticmethod
+    def mismatch_rects(mask, max_gap = 1):
+        '''
+        把不匹配的 cell 合并为矩形 (XY 切分): 每个区域先收缩到不匹配 cell 的包围盒,
+        再沿超过 max_gap 的空行切开, 没有空行时沿空列切开, 直到不能再切
+        分散的 cell 各自成为一个小矩形, 写入的 cell 数接近不匹配的 cell 数
+        返回 [(row_start, row_stop, col_start, col_stop), ...], 坐标相对于 mask
+        '''
+        rects = []
+        regions = [(0, mask.shape[0], 0, mask.shape[1])]
+        while regions:
+            r0, r1, c0, c1 = regions.pop()
+            sub = mask[r0:r1, c0:c1]
+            rows = numpy.flatnonzero(sub.any(axis = 1))
+            if rows.size == 0:
+                continue
+            cols = numpy.flatnonzero(sub.any(axis = 0))
+            r0, r1, c0, c1 = r0 + rows[0], r0 + rows[-1] + 1, c0 + cols[0], c0 + cols[-1] + 1
+            row_runs = SDKArray._index_runs(rows, max_gap)
+            if len(row_runs) > 1:
+                regions.extend((r0 - rows[0] + a, r0 - rows[0] + b, c0, c1) for a, b in row_runs)
+                continue
+            col_runs = SDKArray._index_runs(cols, max_gap)
+            if len(col_runs) > 1:
+                regions.extend((r0, r1, c0 - cols[0] + a, c0 - cols[0] + b) for a, b in col_runs)
+                continue
+            rects.append((int(r0), int(r1), int(c0), int(c1)))
+        rects.sort()
+        return rects
+
+    @classmethod
+    def _split_rewrite(cls, mask, max_gap, max_cover):
+        '''
+        mismatch_rects 给出的矩形中, 面积 / 不匹配 cell 数不超过 max_cover 的整块写入,
+        超过的矩形用更小的 max_gap 重新切分, max_gap 为 0 时仍超过的矩形 (以及单个 cell) 作为分散的 cell
+        返回 (rects, cells), cells 为 [(row, col), ...], 坐标相对于 mask
+        '''
+        rects, cells = [], []
+        for r0, r1, c0, c1 in cls.mismatch_rects(mask, max_gap):
+            sub = mask[r0:r1, c0:c1]
+            area = sub.size
+            if area > 1 and area <= max_cover * int(sub.sum()):
+                rects.append((r0, r1, c0, c1))
+            elif area > 1 and max_gap > 0:
+                sub_rects, sub_cells = cls._split_rewrite(sub, max_gap - 1, max_cover)
+                rects.extend((a + r0, b + r0, c + c0, d + c0) for a, b, c, d in sub_rects)
+                cells.extend((r + r0, c + c0) for r, c in sub_cells)
+            else:
+                rows, cols = numpy.nonzero(sub)
+                cells.extend(zip((rows + r0).tolist(), (cols + c0).tolist()))
+        return rects, cells
+
+    @classmethod
+    def rewrite_cost(cls, mask, rects, cells):
+        '按 REWRITE_*_COST 估计的重写代价: 块写入中不匹配的 cell 记 1, 已正确的 cell 由 FPGA 跳过'
+        cost = len(cells) * cls.REWRITE_PROGRAM_COST
+        for r0, r1, c0, c1 in rects:
+            mismatch = int(mask[r0:r1, c0:c1].sum())
+            cost += cls.REWRITE_BLOCK_COST + mismatch + ((r1 - r0) * (c1 - c0) - mismatch) * cls.REWRITE_SKIP_COST
+        return cost
+
+    @classmethod
+    def plan_rewrite(cls, mask, max_gap = None, max_cover = None, max_cells = None):
+        '''
+        重写计划: 先按 _split_rewrite 得到密集的矩形和分散的 cell, 再在以下方案中选代价 (rewrite_cost) 最小的:
+            密集矩形整块写入 + 分散的 cell 逐个编程 (只在分散的 cell 不超过 max_cells 个时可选);
+            密集矩形整块写入 + 分散的 cell 的包围盒整块写入 (其中已正确的 cell 由 FPGA 跳过);
+            所有不匹配 cell 的包围盒整块写入
+        返回 (rects, cells), cells 为 [(row, col), ...], 坐标相对于 mask
+        '''
+        max_gap = cls.REWRITE_MAX_GAP if max_gap is None else max_gap
+        max_cover = cls.REWRITE_MAX_COVER if max_cover is None else max_cover
+        max_cells = cls.REWRITE_MAX_CELLS if max_cells is None else max_cells
+        rects, cells = cls._split_rewrite(mask, max_gap, max_cover)
+        if not cells:
+            return rects, cells
+
+        def bounding_rect(rows, cols):
+            return (int(min(rows)), int(max(rows)) + 1, int(min(cols)), int(max(cols)) + 1)
+
+        rows, cols = numpy.nonzero(mask)
+        plans = [(rects + [bounding_rect(*zip(*cells))], []), ([bounding_rect(rows, cols)], [])]
+        if len(cells) <= max_cells:
+            plans.append((rects, cells))
+        return min(plans, key = lambda plan: cls.rewrite_cost(mask, *plan))
+
+    def _rewrite_mismatch(self, weight, rowstart, colstart, mask, tolerance = 0):
+        '''
+        按 plan_rewrite 重写不匹配的 cell, 需已处于写权重模式 (switch_mode(1)), 逐个编程时允许误差 tolerance
+        返回 dict(rects, single_cells, cells_written, block_unchanged, single_fail),
+        block_unchanged 为块写入中 FPGA 跳过的已正确 cell 数, single_fail 为 program() 返回失败的 cell 数
+        '''
+        rects, cells = self.plan_rewrite(mask)
+        cells_written = block_unchanged = single_fail = 0
+        for r0, r1, c0, c1 in rects:
+            status = self._write_block(weight[r0:r1, c0:c1], rowstart + r0, colstart + c0, progress = False)
+            cells_written += (r1 - r0) * (c1 - c0)
+            block_unchanged += status[2]
+        if cells:
+            # 逐个 cell 编程 (同 set_weight_ISPP) 在计算模式下进行
+            self._sdk.switch_mode(0)
+            for r, c in cells:
+                if self.program(rowstart + r, colstart + c, int(weight[r, c]), tolerance = tolerance) == 0:
+                    single_fail += 1
+            self._sdk.switch_mode(1)
+            cells_written += len(cells)
+        return dict(rects = len(rects), single_cells = len(cells), cells_written = cells_written,
+                    block_unchanged = int(block_unchanged), single_fail = single_fail)
+
+    def _set_weight_incremental(self, weight, rowstart, colstart, prog_cycle, tolerance, verbose):
+        '''
+        增量写权重: 读回 -> 按 plan_rewrite 只重写不匹配的 cell, 最多 prog_cycle 个 cycle
+        返回 log dict: cycles 为每个 cycle 的 mismatch, rects, single_cells, cells_written, block_unchanged,
+        single_fail 以及 cover_ratio (cells_written / mismatch), mismatch 为最终不匹配的 cell 数
+        '''
+        rowcount, colcount = weight.shape
+        cell_total_num = rowcount * colcount
+        log = dict(cell_total_num = cell_total_num, cycles = [], mismatch = None)
+        time_start = time.time()
+        for cycle in range(prog_cycle + 1):
+            mask = self.mismatch_mask(self._read_block(rowstart, rowcount, colstart, colcount), weight, tolerance)
+            mismatch = int(mask.sum())
+            log['mismatch'] = mismatch
+            if mismatch == 0 or cycle == prog_cycle:
+                break
+            rewrite = self._rewrite_mismatch(weight, rowstart, colstart, mask, tolerance)
+            rewrite.update(mismatch = mismatch, cover_ratio = rewrite['cells_written'] / mismatch)
+            log['cycles'].append(rewrite)
+            if verbose:
+                print(f'Cycle = {cycle + 1}, mismatch = {mismatch}, rewrite {rewrite["rects"]} rects + '
+                      f'{rewrite["single_cells"]} cells / {rewrite["cells_written"]} cells, '
+                      f'{rewrite["single_fail"]} single cells failed')
+        log['time'] = time.time() - time_start
+        if verbose:
+            print("Total time used: %s" % str(datetime.timedelta(seconds = log['time'])).split('.')[0])
+            print(f'Mapping success rate: {cell_total_num - log["mismatch"]} / {cell_total_num}, '
+                  f'{100.0 * (cell_total_num - log["mismatch"]) / cell_total_num:.4f}')
+        return log
+
+    def set_weight_verified(self, weight, addr = None, max_cycle = 10, target_pass_rate = 1.0, tolerance = 0):
+        '''
+        校验写权重: 每个 cycle 读回区域得到误差图, 只重写未通过的 cell (按 plan_rewrite 的代价选择矩形块写入,
+        或在分散的 cell 很少时逐个编程), 通过率达到 target_pass_rate 或达到 max_cycle 时结束, 不打印
+        Args:
+            target_pass_rate: float
+                目标通过率 (0 ~ 1), |读回值 - 目标值| <= tolerance 的 cell 算作通过
+        Returns:
+            report: dict
+                cell_total_num, pass_rate, passed, time,
+                cycles: 每个 cycle 写之前的 pass_rate / fail_num, 重写的 rects / single_cells / cells_written,
+                    block_unchanged (块写入中跳过的 cell 数), single_fail (逐个编程失败的 cell 数),
+                    cover_ratio (cells_written / fail_num) 以及 read_time / write_time,
+                error_map: 最终读回值 - 目标值, int16 [rowcount, colcount]
+        '''
+        weight, addr = self._begin_write(weight, addr)
+        rowstart, rowcount, colstart, colcount = addr
+        cell_total_num = rowcount * colcount
+        report = dict(cell_total_num = cell_total_num, target_pass_rate = target_pass_rate,
+                      tolerance = tolerance, cycles = [])
+        time_start = time.perf_counter()
+        try:
+            for cycle in range(max_cycle + 1):
+                t_read = time.perf_counter()
+                error_map = self._read_block(rowstart, rowcount, colstart, colcount) - weight
+                fail = numpy.abs(error_map) > tolerance
+                fail_num = int(fail.sum())
+                pass_rate = 1.0 - fail_num / cell_total_num
+                t_write = time.perf_counter()
+                if pass_rate >= target_pass_rate or cycle == max_cycle:
+                    break
+                rewrite = self._rewrite_mismatch(weight, rowstart, colstart, fail, tolerance)
+                rewrite.update(cycle = cycle + 1, pass_rate = pass_rate, fail_num = fail_num,
+                               cover_ratio = rewrite['cells_written'] / fail_num,
+                               read_time = t_write - t_read, write_time = time.perf_counter() - t_write)
+                report['cycles'].append(rewrite)
+        finally:
+            self._sdk.switch_mode(0)
+        report.update(pass_rate = pass_rate, fail_num = fail_num, passed = pass_rate >= target_pass_rate,
+                      error_map = error_map, time = time.perf_counter() - time_start)
+        return report
+
     def calculate(self, input, addr = None, runner = None, it_time = 5, data_type = 0, expand_mode = 0):
         '''
         计算一组输入数据, 可使用 runner 改变计算模式
@@ -267,7 +658,8 @@ class SDKArray:
         '计算一组输入数据'
         # print(addr)
         #self._sdk.clib.ElememDev_SwitchMode(1)
-        self._sdk.switch_hd_version(1)
+        self.select(self.id)
+        self.switch_hd_version(1)
         addr = self.to_sdk_addr(addr)
         rowstart, rowcount, colstart, colcount = addr
         input = numpy.asarray(input).astype(numpy.int8)
@@ -281,17 +673,19 @@ class SDKArray:
         # if y1 > 0 or y2 < H:
         #     input = numpy.pad(input, ((0, 0), (y1, H-(y1+y2))), 'constant')
         num = input.shape[0]
-        self.select(self.id)
         self.set_intergration_time(it_time, wl_pre, wl_after, ctrl_delay)
 
         # local_time12 = time.time()
         output0 = self._sdk.elemem_calc_array(input, rowstart, rowcount, colstart, colcount, data_type, expand_mode)
         #self._sdk.clib.ElememDev_SwitchMode(0)
-        self._sdk.switch_hd_version(0)
+        # session 中保持 HD version 1, 退出 session 时再切回
+        if not self.in_session():
+            self.switch_hd_version(0)
+        # output0 是缓冲池中的视图, 原地加 8 后只复制一次
         if data_type==0:
-            output = numpy.array(output0+8).astype(numpy.uint8)
+            output = numpy.add(output0, 8, out = output0).astype(numpy.uint8)
         else:
-            output = output0
+            output = numpy.array(output0)
         # local_time22 = time.time()
         # print(f'calc_onchip_time = {local_time22 - local_time12}')
 
@@ -548,10 +942,11 @@ class SDKArray:
         file.write(data)
         file.close()
 
-    def program(self, rowIdx, colIdx, input_target_value, verbose = 0):
+    def program(self, rowIdx, colIdx, input_target_value, verbose = 0, tolerance = 0):
         # 0: error or fail
         # 1: normal
         # 2: unchanged
+        # tolerance: 与目标值相差不超过 tolerance 即算作通过
 
         if input_target_value < 0 or input_target_value > 15:
             print('invalid input value for mapping!')
@@ -569,13 +964,13 @@ class SDKArray:
                 print('-->', end = ' ')
                 print('[TAR %02d]' % (target_adc), end = ' ', flush = True)
 
-            if current_res_calc == target_adc:
+            if abs(current_res_calc - target_adc) <= tolerance:
                 if verbose:
                     print('PASS', flush = True)
                 return 2
             else:
-                r = self._sdk.map_single_device_2T2R(rowIdx, colIdx, target_adc, tolerance = 0, with_form = 1,
-                                                     verbose = 0)
+                r = self._sdk.map_single_device_2T2R(rowIdx, colIdx, target_adc, tolerance = tolerance,
+                                                     with_form = 1, verbose = 0)
                 # current_res_calc = self._sdk.calcOneCell(rowIdx,colIdx)
                 # current_res_pos = self._sdk.readOneCell(rowIdx,colIdx,'POS')
                 # current_res_neg = self._sdk.readOneCell(rowIdx,colIdx,'NEG')
@@ -699,7 +1094,8 @@ class SDKArray:
         self.set_intergration_time(it_time, wl_pre, wl_after, ctrl_delay)
 
         # local_time12 = time.time()
-        output = self._sdk.calc_array(addr, input)
+        # calc_array 返回缓冲池中的视图, 复制一份再返回
+        output = numpy.array(self._sdk.calc_array(addr, input))
         # local_time22 = time.time()
         # print(f'calc_onchip_time = {local_time22 - local_time12}')
 